@@ -0,0 +1,342 @@
+#!/usr/bin/python
+
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import socket
+import StringIO
+import sys
+import tarfile
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from time import sleep, time
+
+import bwbootstrap
+
+__author__ = 'luke beer - eat.lemons@gmail.com - https://github.com/lukebeer'
+
+""" Benchmarks for the bwbootstrap transfer path against a local stand-in for Xchange.
+
+    The mock server runs in its own process and serves generated artifacts with Basic auth, optional Range
+    support, per-response latency, a per-connection bandwidth cap and mid-stream disconnects. Each scenario
+    runs in a fresh child process so CPU time and peak RSS are its own.
+
+    bash-$ python bwbench.py --size 256 --bandwidth 20480 --latency 50
+"""
+
+MOCK_USERNAME = 'bench@example.com'
+MOCK_PASSWORD = 'bench'
+
+
+def block():
+    """ 1 MB of incompressible data, artifacts repeat it so any range can be generated without storing it.
+        It starts with a shebang so the .bin artifacts pass bwbootstrap's MagicValidator.
+    """
+    head = '#!/bin/sh\nexit 0\n'
+    return head + ''.join(hashlib.sha256(str(n)).digest() for n in xrange(1024 * 1024 / 32))[len(head):]
+
+
+def tarball(size, data):
+    """ A .tar.gz of about size bytes of data, for the patch to pass bwbootstrap's TarGzValidator """
+    buf = StringIO.StringIO()
+    archive = tarfile.open(fileobj=buf, mode='w:gz', compresslevel=1)
+    for n, offset in enumerate(xrange(0, size, len(data))):
+        info = tarfile.TarInfo('patch/part%04d' % n)
+        info.size = min(len(data), size - offset)
+        archive.addfile(info, StringIO.StringIO(data[:info.size]))
+    archive.close()
+    return buf.getvalue()
+
+
+class MockXchangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.headers.get('Authorization') != server.auth:
+            return self.reply(401, headers={'WWW-Authenticate': 'Basic realm="Xchange"'})
+        sleep(server.latency)
+        if self.path.endswith('/'):
+            etag = '"listing-%d"' % len(server.listing)
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304, headers={'ETag': etag})
+            return self.reply(200, '\n'.join(sorted(server.listing)) + '\n', headers={'ETag': etag})
+        name = self.path.rsplit('/', 1)[-1]
+        if name not in server.artifacts:
+            return self.reply(404)
+        size = server.artifacts[name]
+        etag = '"%s-%x"' % (name, size)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match and server.ranges and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or size - 1), size - 1)
+            if start >= size:
+                return self.reply(416, headers={'Content-Range': 'bytes */%d' % size})
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes' if server.ranges else 'none')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.stream(name, start, end + 1)
+
+    def stream(self, name, start, end):
+        server = self.server
+        drop_at = None
+        with server.lock:
+            server.requests[name] = server.requests.get(name, 0) + 1
+            if server.drops.get(name) == server.requests[name] and end - start > server.drop_after:
+                drop_at = start + server.drop_after
+        pos = start
+        started = time()
+        content = server.content.get(name)
+        while pos < end:
+            if content is not None:
+                chunk = content[pos:pos + min(64 * 1024, end - pos)]
+            else:
+                chunk = server.block[pos % len(server.block):][:min(64 * 1024, end - pos)]
+            if drop_at is not None and pos + len(chunk) >= drop_at:
+                self.wfile.write(chunk[:drop_at - pos])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            if server.bandwidth:
+                ahead = float(pos - start) / server.bandwidth - (time() - started)
+                if ahead > 0:
+                    sleep(ahead)
+
+    def reply(self, code, body='', headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockXchange(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Stand-in for bss_url, ips_url and swm_url. artifacts maps file name to size, the directory listing is
+        the swmanager names. The drops[name]th request for name is cut off after drop_after bytes.
+        .tar.gz artifacts are real tarballs held in content, everything else repeats block.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, artifacts, ranges=True, latency=0.0, bandwidth=0, drops=None, drop_after=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockXchangeHandler)
+        self.auth = 'Basic %s' % base64.b64encode('%s:%s' % (MOCK_USERNAME, MOCK_PASSWORD))
+        self.block = block()
+        self.content = dict((name, tarball(size, self.block)) for name, size in artifacts.items()
+                            if name.endswith('.tar.gz'))
+        self.artifacts = dict(artifacts, **dict((name, len(data)) for name, data in self.content.items()))
+        self.listing = [name for name in artifacts if name.startswith('swmanager_')]
+        self.ranges = ranges
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drops = dict(drops or {})
+        self.drop_after = drop_after
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+def serve(queue, kwargs):
+    server = MockXchange(**kwargs)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock(**kwargs):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(queue, kwargs))
+    process.daemon = True
+    process.start()
+    return process, 'http://127.0.0.1:%d/' % queue.get(timeout=30)
+
+
+def artifacts(size):
+    return {'AS_Rel_21.sp1_1.551.Linux-x86_64.bin': size,
+            'IP.as.21.sp1.551.ip20150224.Linux-x86_64.tar.gz': max(size / 8, 1024),
+            'swmanager_549314.bin': max(size / 16, 1024),
+            'swmanager_1003121.bin': max(size / 16, 1024)}
+
+
+def point_at(url, workdir):
+    bwbootstrap.bss_url = bwbootstrap.ips_url = bwbootstrap.swm_url = url + 'XchangeRepos/GA/co/noarch/'
+    bwbootstrap.session = bwbootstrap.XchangeSession(MOCK_USERNAME, MOCK_PASSWORD, proxy=None)
+    bwbootstrap.logger.setLevel(bwbootstrap.logging.ERROR)
+    bwbootstrap.DOWNLOAD_BACKOFF = 0.1
+    bwbootstrap.SEGMENT_THRESHOLD = 1024 * 1024
+    bwbootstrap.listing_index = bwbootstrap.ListingIndex(os.path.join(workdir, 'listings.json'), ttl=0, stale=0)
+    return os.path.join(workdir, 'install') + '/'
+
+
+def scenario_download(url, workdir, o, segments=1):
+    path = point_at(url, workdir)
+    name = 'AS_Rel_21.sp1_1.551.Linux-x86_64.bin'
+    return bwbootstrap.download(bwbootstrap.bss_url, name, path + name, report_hook=None, segments=segments,
+                                cache_dir='', chunk_size=o.chunk_size)
+
+
+def scenario_listing(url, workdir, o):
+    """ Every fetch revalidates the listing index with a conditional GET """
+    point_at(url, workdir)
+    for _ in range(o.iterations):
+        assert bwbootstrap.get_latest_swman() == 'swmanager_1003121.bin'
+    return 0
+
+
+def scenario_listing_cold(url, workdir, o):
+    """ Every fetch starts without a listing index and transfers the full listing """
+    point_at(url, workdir)
+    for _ in range(o.iterations):
+        bwbootstrap.get_latest_swman()
+        os.remove(bwbootstrap.listing_index.path)
+    return 0
+
+
+def scenario_flow(url, workdir, o):
+    """ The --install --download --skipprep path: every artifact, unattended.conf and +x, no installer """
+    path = point_at(url, workdir)
+    result = dict(bwbootstrap.configs['as']['software']['21.sp1.551'], type='as', release='21.sp1.551',
+                  options=bwbootstrap.configs['as']['options'])
+    flow = type('Options', (object,), {'concurrency': bwbootstrap.DOWNLOAD_CONCURRENCY, 'cache_dir': '',
+                                       'segments': bwbootstrap.DOWNLOAD_SEGMENTS, 'download_only': True,
+                                       'manifest': os.path.join(workdir, 'manifest.json'), 'fqdn': 'bench',
+                                       'peers': [], 'port': bwbootstrap.PEER_PORT, 'from_bundle': None})
+    stages, progress = bwbootstrap.bootstrap_stages(result, flow, path, False, False, None)
+    results = bwbootstrap.run_stages(stages)
+    return sum(os.path.getsize(path + results[stage.name]) for stage in stages if stage.name.startswith('download:'))
+
+
+def scenario_segmented(url, workdir, o):
+    return scenario_download(url, workdir, o, segments=4)
+
+
+def scenario_segmented_resume(url, workdir, o):
+    """ A segmented download loses a segment and gives up, then a --segments 1 run finishes the .part it left """
+    path = point_at(url, workdir)
+    name = 'AS_Rel_21.sp1_1.551.Linux-x86_64.bin'
+    try:
+        bwbootstrap.download(bwbootstrap.bss_url, name, path + name, report_hook=None, segments=4, cache_dir='',
+                             chunk_size=o.chunk_size, retries=0)
+        raise AssertionError('segmented download was not interrupted')
+    except bwbootstrap.DownloadError:
+        pass
+    size = scenario_download(url, workdir, o)
+    data = block()
+    with open(path + name, 'rb') as fh:
+        for offset in xrange(0, size, len(data)):
+            if fh.read(len(data)) != data[:size - offset]:
+                raise AssertionError('%s differs from the served copy in the MB at %d' % (name, offset))
+    return size
+
+
+# (name, scenario, mock server settings), drop cuts that request for each artifact off half way through, or
+# after 1/drop_after of the file, request 1 being download()'s probe
+scenarios = [
+    ('stream', scenario_download, {}),
+    ('segmented', scenario_segmented, {}),
+    ('resume', scenario_download, {'drop': 2}),
+    ('no-ranges', scenario_download, {'drop': 2, 'ranges': False}),
+    ('segmented-resume', scenario_segmented_resume, {'drop': 2, 'drop_after': 8}),
+    ('listing', scenario_listing, {}),
+    ('listing-cold', scenario_listing_cold, {}),
+    ('download-flow', scenario_flow, {}),
+]
+
+
+def run_scenario(queue, func, url, o):
+    workdir = tempfile.mkdtemp(prefix='bwbench')
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        before = os.times()
+        started = time()
+        transferred = func(url, workdir, o)
+        wall = time() - started
+        after = os.times()
+        queue.put({'wall': wall, 'bytes': transferred, 'cpu': (after[0] - before[0]) + (after[1] - before[1]),
+                   'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    except Exception, e:
+        queue.put({'error': '%s: %s' % (e.__class__.__name__, e)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(name, func, server_kwargs, o):
+    process, url = start_mock(**server_kwargs)
+    try:
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=run_scenario, args=(queue, func, url, o))
+        child.start()
+        result = queue.get()
+        child.join()
+    finally:
+        process.terminate()
+    result['scenario'] = name
+    return result
+
+
+def opts():
+    op = OptionParser(usage='%s [options] [scenario ...]' % sys.argv[0])
+    op.add_option('--size', dest='size', type='int', default=64, help='Installer size in MB (default: 64)')
+    op.add_option('--latency', dest='latency', type='int', default=0, help='Per response latency in ms')
+    op.add_option('--bandwidth', dest='bandwidth', type='int', default=0,
+                  help='Per connection bandwidth cap in KB/s, 0 for unlimited')
+    op.add_option('--chunk-size', dest='chunk_size', type='int', default=bwbootstrap.DOWNLOAD_CHUNK,
+                  help='download() initial read size')
+    op.add_option('--iterations', dest='iterations', type='int', default=20, help='Listing fetches per run')
+    op.add_option('--repeat', dest='repeat', type='int', default=1, help='Runs per scenario')
+    op.add_option('--json', dest='json', help='Also write results to this JSON file')
+    return op.parse_args()
+
+
+def main():
+    o, names = opts()
+    size = o.size * 1024 * 1024
+    results = []
+    print "%-16s %9s %10s %9s %10s %9s" % ('scenario', 'wall s', 'MB/s', 'cpu s', 'cpu s/GB', 'rss MB')
+    for name, func, server in scenarios:
+        if names and name not in names:
+            continue
+        kwargs = {'artifacts': artifacts(size), 'latency': o.latency / 1000.0, 'bandwidth': o.bandwidth * 1024,
+                  'ranges': server.get('ranges', True), 'drop_after': size / server.get('drop_after', 2),
+                  'drops': dict((a, server['drop']) for a in artifacts(size)) if server.get('drop') else None}
+        for _ in range(o.repeat):
+            result = measure(name, func, kwargs, o)
+            results.append(result)
+            if 'error' in result:
+                print "%-16s %s" % (name, result['error'])
+                continue
+            gb = result['bytes'] / 1024.0 ** 3
+            print "%-16s %9.2f %10.1f %9.2f %10s %9.1f" % (
+                name, result['wall'], result['bytes'] / 1024.0 / 1024 / result['wall'], result['cpu'],
+                '%.2f' % (result['cpu'] / gb) if gb else '-', result['rss'] / 1024.0)
+    if o.json:
+        with open(o.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,36 @@
 #!/usr/bin/python
 
+import BaseHTTPServer
+import ConfigParser
+import SocketServer
 import base64
+import fcntl
+import hashlib
+import hmac
+import httplib
+import json
 import logging
+import logging.handlers
 import os
+import random
+import re
+import shutil
+import signal
 import socket
+import ssl
 import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import urllib2
+import urlparse
+import zlib
 from collections import OrderedDict
+from contextlib import contextmanager
 from optparse import OptionParser
-from time import sleep
+from time import localtime, sleep, time
 
 __author__ = 'luke beer - eat.lemons@gmail.com - https://github.com/lukebeer'
 
@@ -45,11 +65,55 @@ logger.setLevel(logging.INFO)
 
 XCHANGE_USERNAME = os.getenv('XCHANGE_USER', 'mail@example.com')
 XCHANGE_PASSWORD = os.getenv('XCHANGE_PASS', 'password')
+XCHANGE_PROXY = os.getenv('XCHANGE_PROXY', os.getenv('https_proxy', os.getenv('http_proxy')))
+XCHANGE_CA_BUNDLE = os.getenv('XCHANGE_CA_BUNDLE')
+XCHANGE_TIMEOUT = int(os.getenv('XCHANGE_TIMEOUT', '60'))
+RESOLVE_TIMEOUT = float(os.getenv('BW_RESOLVE_TIMEOUT', '5'))
 
 bss_url = 'http://xchange.broadsoft.com/XchangeRepos/GA/__RELEASE__/bss/Linux/'
-ips_url = 'http://xchange.broadsoft.com/XchangeRepos/GA/_RELEASE__/ips/'
+ips_url = 'http://xchange.broadsoft.com/XchangeRepos/GA/__RELEASE__/ips/'
 swm_url = 'http://xchange.broadsoft.com/XchangeRepos/GA/co/noarch/'
 
+DOWNLOAD_CONCURRENCY = int(os.getenv('BW_DOWNLOAD_CONCURRENCY', '3'))
+DOWNLOAD_RETRIES = int(os.getenv('BW_DOWNLOAD_RETRIES', '5'))
+DOWNLOAD_BACKOFF = 2.0
+DOWNLOAD_SEGMENTS = int(os.getenv('BW_DOWNLOAD_SEGMENTS', '4'))
+SEGMENT_THRESHOLD = int(os.getenv('BW_SEGMENT_THRESHOLD', str(64 * 1024 * 1024)))
+SEGMENT_CHECKPOINT = 4 * 1024 * 1024
+DOWNLOAD_CHUNK = 64 * 1024
+DOWNLOAD_BUFFER = int(os.getenv('BW_DOWNLOAD_BUFFER', str(1024 * 1024)))
+CHUNK_TARGET = 0.05
+PROGRESS_INTERVAL = 0.2
+BANDWIDTH = os.getenv('BW_BANDWIDTH', '0')
+BANDWIDTH_FILE = os.getenv('BW_BANDWIDTH_FILE', '/etc/bwbootstrap/bandwidth')
+BANDWIDTH_BURST = 0.25
+BANDWIDTH_RECHECK = 1.0
+CACHE_DIR = os.getenv('BW_CACHE_DIR', '/var/cache/bwbootstrap')
+CACHE_MAX_SIZE = int(os.getenv('BW_CACHE_MAX_SIZE', str(20 * 1024 * 1024 * 1024)))
+FICLONE = 0x40049409
+MANIFEST_FILE = os.getenv('BW_MANIFEST', '/etc/bwbootstrap/manifest.json')
+MANIFEST_KEY = os.getenv('BW_MANIFEST_KEY')
+REPORT_FILE = os.getenv('BW_REPORT', '/var/log/bwbootstrap/report.json')
+INSTALLER_LOG = os.getenv('BW_INSTALLER_LOG', '/var/log/bwbootstrap/installer.log')
+INSTALLER_LOG_SIZE = 10 * 1024 * 1024
+INSTALLER_LOG_BACKUPS = 5
+INSTALLER_TIMEOUT = int(os.getenv('BW_INSTALLER_TIMEOUT', '0'))
+INSTALLER_KILL_GRACE = 30
+LISTING_INDEX = os.getenv('BW_LISTING_INDEX', '/var/lib/bwbootstrap/listings.json')
+LISTING_TTL = int(os.getenv('BW_LISTING_TTL', '300'))
+LISTING_STALE = int(os.getenv('BW_LISTING_STALE', '86400'))
+STATE_FILE = os.getenv('BW_STATE', '/var/lib/bwbootstrap/state.json')
+RESUME_UNIT = 'bwbootstrap-resume'
+BUNDLE_MAGIC = 'BWBUNDL1'
+BUNDLE_REPO = 'bwbootstrap-bundle'
+RPM_CACHE = os.getenv('BW_RPM_CACHE', '/var/cache/bwbootstrap-rpms')
+RPM_REPO = 'bwbootstrap-rpms'
+RPM_CONCURRENCY = int(os.getenv('BW_RPM_CONCURRENCY', '8'))
+INSTALL_DIR = '/bw/install/'
+PEERS = [p for p in os.getenv('BW_PEERS', '').split(',') if p]
+PEER_PORT = int(os.getenv('BW_PEER_PORT', '8080'))
+PEER_TIMEOUT = int(os.getenv('BW_PEER_TIMEOUT', '10'))
+
 general_options = {
     'BROADWORKS_USERNAME': 'bwadmin',
     'NTP_CONFIG': 'CLIENT',
@@ -85,13 +149,13 @@ configs = {
         },
         'options': {
             'SERVER_TYPE': 'ApplicationServer',
-            'REDHOSTNAME': socket.getfqdn(),
-            'REDPRIMARYHOSTNAME': socket.getfqdn(),
+            'REDHOSTNAME': '__FQDN__',
+            'REDPRIMARYHOSTNAME': '__FQDN__',
             'REDPRIMARY': 'true',
-            'REDPEERS': '{%s->%s,}' % (socket.getfqdn(), socket.getfqdn()),
+            'REDPEERS': '{__FQDN__->__FQDN__,}',
             'REDREPPORT': '17888',
-            'APP_SERVER_ID': socket.gethostname(),
-            'VIRTUALDOMAIN': socket.getfqdn(),
+            'APP_SERVER_ID': '__HOSTNAME__',
+            'VIRTUALDOMAIN': '__FQDN__',
             'JASS': 'false',
             'FTP_ON': 'true',
             'TFTP_ON': 'false',
@@ -99,7 +163,7 @@ configs = {
             'USESSL': 'true',
             'FULLSSL': 'false',
             'NTP_SERVER': 'pool.ntp.org',
-            'APACHEHOSTNAME': socket.getfqdn(),
+            'APACHEHOSTNAME': '__FQDN__',
             'REDUNDANTSERVER': 'false',
             'HAS_DATABASE': 'true',
             'SERVER_DSN': 'AppServer',
@@ -163,10 +227,10 @@ configs = {
         },
         'options': {
             'SERVER_TYPE': 'NetworkServer',
-            'REDHOSTNAME': socket.getfqdn(),
-            'REDPRIMARYHOSTNAME': socket.getfqdn(),
+            'REDHOSTNAME': '__FQDN__',
+            'REDPRIMARYHOSTNAME': '__FQDN__',
             'REDPRIMARY': 'true',
-            'REDPEERS': '{%s->%s,}' % (socket.getfqdn(), socket.getfqdn()),
+            'REDPEERS': '{__FQDN__->__FQDN__,}',
             'REDREPPORT': '17888',
             'JASS': 'false',
             'FTP_ON': 'true',
@@ -340,10 +404,40 @@ packages = ['imake.x86_64', 'basesystem.noarch', 'gdb.x86_64', 'nss-softokn-free
             'cpp.x86_64', 'boost-python.x86_64', 'boost-iostreams.x86_64', 'boost-test.x86_64',
             'libstdc++-devel.x86_64', 'unixODBC.x86_64']
 
+os_file_edits = [
+    ('Disabling selinux', '/etc/selinux/config', r'^SELINUX=.*$', 'SELINUX=disabled'),
+    ('Changing snmpd OID', '/etc/snmp/snmpd.conf', r'\.1\.3\.6\.1\.2\.1\.1(?!\d)', '.1.3.6.1.2.1'),
+    ('Updating sysstat collection to every 5 minuets', '/etc/cron.d/sysstat',
+     r'\*/[0-9]+ \* \* \* \* root /usr/lib64/sa/sa1', '*/5 * * * * root /usr/lib64/sa/sa1')
+]
+
+os_sysctl = OrderedDict([
+    ('net.ipv6.conf.all.disable_ipv6', '1'),
+    ('net.ipv6.conf.default.disable_ipv6', '1'),
+    ('net.ipv6.conf.lo.disable_ipv6', '1')
+])
+
+os_services = OrderedDict([('snmpd', True), ('iptables', False)])
+os_service_configs = {'snmpd': '/etc/snmp/snmpd.conf'}
+
+# (phase, pattern) in the order the installer runs them, a line matching a pattern starts that phase
+installer_phases = [
+    ('checks', r'(?i)checking (system|prerequisites|requirements)|verifying'),
+    ('extract', r'(?i)extracting|unpacking'),
+    ('rpms', r'(?i)installing .*\.rpm|installing rpms?\b|preparing packages'),
+    ('timesten', r'(?i)timesten|creating (the )?(database|datastore)|\bdsn\b'),
+    ('patches', r'(?i)applying patch|installing patch|patch(es)? (installed|applied)'),
+    ('services', r'(?i)starting (broadworks|server|services)|bwstart|startbw')
+]
+
 ordered_configs = OrderedDict(sorted(configs.items(), key=lambda t: t[0]))
 
+session = None
+session_lock = threading.Lock()
+host_identity = None
+
 
-def opts():
+def opts(args=None):
     usage = '%s [-u url] [-n names] [-p prefix]' % sys.argv[0]
     op = OptionParser(usage=usage)
     release_help = '\n'
@@ -360,28 +454,114 @@ def opts():
     op.add_option('--install', dest='install', action='store_true',
                   help='Perform install assuming system is configured already')
     op.add_option('--download', dest='download_only', action='store_true', help='Download software only')
-    (o, args) = op.parse_args()
+    op.add_option('--concurrency', dest='concurrency', type='int', default=DOWNLOAD_CONCURRENCY,
+                  help='Number of parallel downloads (default: %d)' % DOWNLOAD_CONCURRENCY)
+    op.add_option('--segments', dest='segments', type='int', default=DOWNLOAD_SEGMENTS,
+                  help='Parallel range requests per file over %d MB, 1 to disable (default: %d)' % (
+                      SEGMENT_THRESHOLD / 1024 / 1024, DOWNLOAD_SEGMENTS))
+    op.add_option('--cache-dir', dest='cache_dir', default=CACHE_DIR,
+                  help='Shared artifact cache, may be on NFS (default: %s)' % CACHE_DIR)
+    op.add_option('--no-cache', dest='cache_dir', action='store_const', const='', help='Disable the artifact cache')
+    op.add_option('--rpm-cache', dest='rpm_cache', default=RPM_CACHE,
+                  help='Local yum repo of the prep RPMs, may be on NFS (default: %s)' % RPM_CACHE)
+    op.add_option('--no-rpm-cache', dest='rpm_cache', action='store_const', const='',
+                  help='Install the prep RPMs straight from the configured repos')
+    op.add_option('--rpm-concurrency', dest='rpm_concurrency', type='int', default=RPM_CONCURRENCY,
+                  help='Parallel RPM fetches when filling the RPM cache (default: %d)' % RPM_CONCURRENCY)
+    op.add_option('--bandwidth', dest='bandwidth', default=BANDWIDTH, metavar='SCHEDULE',
+                  help='Cap for all downloads together, a rate like 2M or windows like 08:00-18:00=2M,0 '
+                  '(default: %s)' % BANDWIDTH)
+    op.add_option('--bandwidth-file', dest='bandwidth_file', default=BANDWIDTH_FILE,
+                  help='Control file overriding --bandwidth, re-read when it changes or on SIGUSR1 '
+                  '(default: %s)' % BANDWIDTH_FILE)
+    op.add_option('--fqdn', dest='fqdn', default=os.getenv('BW_FQDN'),
+                  help='FQDN for the unattended config instead of resolving it')
+    op.add_option('--report', dest='report', default=REPORT_FILE,
+                  help='JSON run report with stage and download timings (default: %s)' % REPORT_FILE)
+    op.add_option('--statsd', dest='statsd', help='Send run metrics to StatsD at host:port')
+    op.add_option('--prom-textfile', dest='prom_textfile', help='Write run metrics to a Prometheus textfile')
+    op.add_option('--manifest', dest='manifest', default=MANIFEST_FILE,
+                  help='Known-good artifact checksums (default: %s)' % MANIFEST_FILE)
+    op.add_option('--serve', dest='serve', action='store_true',
+                  help='Serve %s and the artifact cache to LAN peers over HTTP' % INSTALL_DIR)
+    op.add_option('--peer', dest='peers', action='append', default=list(PEERS),
+                  help='Fetch from a LAN peer running --serve before Xchange, host[:port], repeat or comma separate')
+    op.add_option('--port', dest='port', type='int', default=PEER_PORT,
+                  help='Port for --serve and default --peer port (default: %d)' % PEER_PORT)
+    op.add_option('-y', '--yes', dest='yes', action='store_true',
+                  help='Answer yes to the configure and reboot prompts, for unattended runs')
+    op.add_option('--bundle', dest='bundle', metavar='PATH',
+                  help='Pack the release, its RPMs and unattended.conf into one file for offline installs')
+    op.add_option('--from-bundle', dest='from_bundle', metavar='PATH',
+                  help='Install from a --bundle file instead of Xchange and the yum mirrors')
+    op.add_option('--installer-timeout', dest='installer_timeout', type='int', default=INSTALLER_TIMEOUT,
+                  metavar='SECONDS', help='Stop the installer if it runs longer than this, 0 for no limit '
+                  '(default: %d)' % INSTALLER_TIMEOUT)
+    op.add_option('--installer-log', dest='installer_log', default=INSTALLER_LOG,
+                  help='Timestamped, rotated copy of the installer output (default: %s)' % INSTALLER_LOG)
+    op.add_option('--state', dest='state', default=STATE_FILE,
+                  help='Journal of completed stages, remove it to start over (default: %s)' % STATE_FILE)
+    op.add_option('--resume', dest='resume', action='store_true',
+                  help='Continue the run armed before the last reboot, as the boot unit does')
+    (o, args) = op.parse_args(args)
+    try:
+        parse_schedule(o.bandwidth)
+    except ValueError, e:
+        op.error('--bandwidth: %s' % e)
+    o.peers = [p for peer in o.peers for p in peer.split(',') if p]
     result = {}
+    if o.from_bundle and not (o.type and o.release):
+        index = Bundle(o.from_bundle).index
+        o.type, o.release = index['type'], index['release']
     if o.type and o.release:
+        result = dict(ordered_configs[o.type]['software'][o.release])
         result['type'] = o.type
         result['options'] = ordered_configs[o.type]['options']
         result['release'] = o.release
     if not result:
-        print
-        op.print_help()
-        print "\n\n \x1b[36m*** Defaulting to interactive menu, ctl+c to cancel ***\x1b[0m "
+        if not o.serve:
+            print
+            op.print_help()
+            print "\n\n \x1b[36m*** Defaulting to interactive menu, ctl+c to cancel ***\x1b[0m "
         return None, o
     else:
         return result, o
 
 
-def createUnattenededInstallConfig(save_as, server_config):
+def resolve_host_identity(fqdn=None, timeout=RESOLVE_TIMEOUT):
+    """ Values for the __FQDN__ and __HOSTNAME__ placeholders in configs, resolved once on first use.
+        getfqdn() runs in a daemon thread so a broken resolver costs at most timeout seconds, after which
+        the plain hostname is used. fqdn overrides the lookup entirely.
+    """
+    global host_identity
+    if host_identity is None:
+        hostname = socket.gethostname()
+        if not fqdn:
+            result = []
+            resolver = threading.Thread(target=lambda: result.append(socket.getfqdn()))
+            resolver.daemon = True
+            resolver.start()
+            resolver.join(timeout)
+            if not result:
+                logger.warning("\x1b[33mResolving FQDN timed out after %ss, using %s\x1b[0m" % (timeout, hostname))
+            fqdn = result[0] if result else hostname
+        host_identity = {'__FQDN__': fqdn, '__HOSTNAME__': hostname}
+    return host_identity
+
+
+def createUnattenededInstallConfig(save_as, server_config, fqdn=None, identity=None):
+    """ Write unattended.conf, identity maps placeholders to values and defaults to this host's, pass {} to leave
+        the placeholders in for another host to fill in with fill_placeholders()
+    """
     config = dict(general_options.items() + server_config.items())
     createDirForFile(save_as)
+    identity = resolve_host_identity(fqdn) if identity is None else identity
     try:
         fh = open(save_as, 'w')
         for k, v in config.iteritems():
             if type(v) == str:
+                for placeholder, value in identity.items():
+                    v = v.replace(placeholder, value)
                 fh.write("%s=%s\n" % (k, v))
             if type(v) == set:
                 fh.write("".join(["%s=%s\n" % (k, v) for v in v]))
@@ -391,8 +571,20 @@ def createUnattenededInstallConfig(save_as, server_config):
         logger.error("\x1b[31mUnattended config build failed: %s\x1b[0m" % e)
 
 
+def fill_placeholders(path, fqdn=None):
+    """ Replace the __FQDN__ style placeholders in a file written with identity={} by this host's values """
+    with open(path) as fh:
+        data = fh.read()
+    for placeholder, value in resolve_host_identity(fqdn).items():
+        data = data.replace(placeholder, value)
+    with open(path + '.tmp', 'w') as fh:
+        fh.write(data)
+    os.rename(path + '.tmp', path)
+    logger.info("\x1b[32mCreated unattended installation file %s\x1b[0m" % path)
+
+
 def chunk_report(bytes_so_far, chunk_size, total_size):
-    percent = float(bytes_so_far) / total_size
+    percent = float(bytes_so_far) / total_size if total_size else 0.0
     percent = round(percent * 100, 2)
     sys.stdout.write("Downloaded %d of %d bytes (%0.2f%%)\r" %
                      (bytes_so_far, total_size, percent))
@@ -400,43 +592,1644 @@ def chunk_report(bytes_so_far, chunk_size, total_size):
         sys.stdout.write('\n')
 
 
+class RunReport(object):
+    """ Stage timings, transfer statistics and the installer result for one run, written out as JSON and
+        optionally pushed to StatsD or a Prometheus node_exporter textfile.
+    """
+
+    def __init__(self):
+        self.started = time()
+        self.lock = threading.Lock()
+        self.info = {}
+        self.stages = OrderedDict()
+        self.downloads = OrderedDict()
+        self.installer = {}
+        self.packages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time()
+        status = 'ok'
+        try:
+            yield
+        except:
+            status = 'failed'
+            raise
+        finally:
+            with self.lock:
+                self.stages[name] = {'offset': round(started - self.started, 3),
+                                     'duration': round(time() - started, 3), 'status': status}
+
+    def skip(self, name):
+        with self.lock:
+            self.stages[name] = {'offset': round(time() - self.started, 3), 'duration': 0, 'status': 'skipped'}
+
+    def transfer(self, item, stats):
+        duration = time() - stats.pop('started')
+        first_byte = stats.pop('first_byte')
+        stats.update({'duration': round(duration, 3),
+                      'time_to_first_byte': round(first_byte, 3) if first_byte is not None else None,
+                      'bytes_per_sec': int(stats['bytes'] / duration) if duration else 0,
+                      'throttled': round(stats.get('throttled', 0), 3)})
+        with self.lock:
+            self.downloads[item] = stats
+
+    def as_dict(self):
+        with self.lock:
+            return {'started': self.started, 'duration': round(time() - self.started, 3), 'info': self.info,
+                    'stages': self.stages, 'downloads': self.downloads, 'installer': self.installer,
+                    'packages': self.packages, 'bandwidth': bandwidth.summary()}
+
+    def metrics(self):
+        """ (name, labels, value) samples for StatsD and Prometheus """
+        data = self.as_dict()
+        samples = [('run_duration_seconds', {}, data['duration'])]
+        for name, stage in data['stages'].items():
+            samples.append(('stage_duration_seconds', {'stage': name}, stage['duration']))
+        for item, stats in data['downloads'].items():
+            samples.append(('download_bytes_per_second', {'item': item}, stats['bytes_per_sec']))
+            samples.append(('download_retries', {'item': item}, stats['retries']))
+        for key in ('exit_code', 'duration'):
+            if key in data['installer']:
+                samples.append(('installer_%s' % key, {}, data['installer'][key]))
+        for phase, duration in data['installer'].get('phases', {}).items():
+            samples.append(('installer_phase_duration_seconds', {'phase': phase}, duration))
+        samples.append(('bandwidth_limit_bytes_per_second', {}, data['bandwidth']['limit']))
+        for priority, stats in data['bandwidth']['priorities'].items():
+            samples.append(('bandwidth_bytes', {'priority': str(priority)}, stats['bytes']))
+            samples.append(('bandwidth_throttled_seconds', {'priority': str(priority)}, stats['throttled_seconds']))
+        for key in ('cache_hit_rate', 'fetched', 'fetched_bytes', 'fetch_duration', 'install_duration'):
+            if key in data['packages']:
+                samples.append(('packages_%s' % key, {}, data['packages'][key]))
+        return samples
+
+    def write(self, path):
+        createDirForFile(path)
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(self.as_dict(), fh, indent=2)
+        os.rename(path + '.tmp', path)
+
+    def write_prometheus(self, path):
+        lines = []
+        for name, labels, value in self.metrics():
+            tags = ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+            lines.append('bwbootstrap_%s%s %s' % (name, '{%s}' % tags if tags else '', value))
+        createDirForFile(path)
+        with open(path + '.tmp', 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        os.rename(path + '.tmp', path)
+
+    def send_statsd(self, address):
+        host, _, port = address.partition(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for name, labels, value in self.metrics():
+            metric = '.'.join(['bwbootstrap', name] + [re.sub(r'[^\w-]', '_', v) for k, v in sorted(labels.items())])
+            sock.sendto('%s:%s|g' % (metric, value), (host, int(port or 8125)))
+        sock.close()
+
+
+report = RunReport()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ManifestError(DownloadError):
+    pass
+
+
+class ValidationError(DownloadError):
+    pass
+
+
+def as_bytes(data):
+    """ read_blocks() yields memoryviews, str() of one is its repr in Python 2 """
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+
+class MagicValidator(object):
+    """ Checks an installer starts like an ELF binary or a shell script, eg: not an Xchange login page """
+    signatures = ('\x7fELF', '#!')
+
+    def __init__(self):
+        self.head = ''
+        self.checked = False
+
+    def feed(self, data):
+        if not self.checked:
+            self.head += as_bytes(data[:16 - len(self.head)])
+            if len(self.head) >= 4:
+                self.check()
+
+    def check(self):
+        self.checked = True
+        if not self.head.startswith(self.signatures):
+            raise ValidationError('not an executable, starts with %r%s' % (
+                self.head, ', an HTML page?' if self.head.lstrip().startswith('<') else ''))
+
+    def finish(self):
+        if not self.checked:
+            self.check()
+
+    def summary(self):
+        return {}
+
+
+class TarGzValidator(object):
+    """ Inflates a .tar.gz as it arrives and walks its tar headers, checksums included, through to the gzip
+        trailer, so a corrupt or truncated patch fails during the download instead of in the installer.
+        members indexes the entries, by their GNU or pax long name where they have one.
+    """
+
+    def __init__(self):
+        self.pending = ''
+        self.inflate = None
+        self.header = ''
+        self.skip = 0
+        self.ended = False
+        self.members = []
+        self.extended = None
+        self.long_name = None
+
+    def feed(self, data):
+        if self.inflate is None:
+            self.pending += as_bytes(data)
+            if len(self.pending) < 2:
+                return
+            if not self.pending.startswith('\x1f\x8b'):
+                raise ValidationError('not gzip data, starts with %r%s' % (
+                    self.pending[:16], ', an HTML page?' if self.pending.lstrip().startswith('<') else ''))
+            self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data, self.pending = self.pending, ''
+        try:
+            self.walk(self.inflate.decompress(as_bytes(data)))
+        except zlib.error, e:
+            raise ValidationError('corrupt gzip stream after %d tar members: %s' % (len(self.members), e))
+
+    def walk(self, data):
+        pos = 0
+        while pos < len(data) and not self.ended:
+            if self.skip:
+                n = min(self.skip, len(data) - pos)
+                if self.extended is not None:
+                    self.extended[1] += data[pos:pos + n]
+                self.skip -= n
+                pos += n
+                if not self.skip and self.extended is not None:
+                    self.apply_extended(*self.extended)
+                continue
+            n = min(512 - len(self.header), len(data) - pos)
+            self.header += data[pos:pos + n]
+            pos += n
+            if len(self.header) == 512:
+                self.parse(self.header)
+                self.header = ''
+
+    def parse(self, block):
+        if block == '\0' * 512:
+            self.ended = True
+            return
+        try:
+            checksum = int(block[148:156].strip(' \0') or '0', 8)
+            if block[124] >= '\x80':
+                size = reduce(lambda n, b: n << 8 | ord(b), block[125:136], 0)
+            else:
+                size = int(block[124:136].strip(' \0') or '0', 8)
+        except ValueError:
+            raise ValidationError('malformed tar header after %d members' % len(self.members))
+        unsigned = sum(bytearray(block[:148])) + 8 * 32 + sum(bytearray(block[156:]))
+        signed = unsigned - sum(256 for b in bytearray(block[:148] + block[156:]) if b > 127)
+        if checksum not in (unsigned, signed):
+            raise ValidationError('tar header checksum mismatch after %d members' % len(self.members))
+        name = block[:100].split('\0', 1)[0]
+        if block[257:262] == 'ustar' and block[345] != '\0':
+            name = '%s/%s' % (block[345:500].split('\0', 1)[0], name)
+        if block[156] in 'Lx':
+            self.extended = [block[156], '']
+            if not size:
+                self.apply_extended(*self.extended)
+        elif block[156] not in 'Kg':
+            self.members.append((self.long_name or name, size))
+            self.long_name = None
+        self.skip = (size + 511) // 512 * 512
+
+    def apply_extended(self, kind, data):
+        """ A GNU long name (L) or pax header (x) names the member that follows it """
+        self.extended = None
+        if kind == 'L':
+            self.long_name = data.split('\0', 1)[0]
+            return
+        pos = 0
+        while pos < len(data) and data[pos] != '\0':
+            try:
+                length = int(data[pos:data.index(' ', pos)])
+                key, value = data[data.index(' ', pos) + 1:pos + length - 1].split('=', 1)
+            except ValueError:
+                raise ValidationError('malformed pax header after %d members' % len(self.members))
+            if length <= 0:
+                raise ValidationError('malformed pax header after %d members' % len(self.members))
+            if key == 'path':
+                self.long_name = value
+            pos += length
+
+    def finish(self):
+        if self.inflate is None:
+            raise ValidationError('%d bytes is too short for a .tar.gz' % len(self.pending))
+        if not self.ended:
+            raise ValidationError('tar stream truncated after %d members' % len(self.members))
+        # zlib checks the CRC32 and ISIZE trailer once it reaches it but Python 2 doesn't say whether it has,
+        # a byte fed past the end of a complete gzip stream comes back as unused_data, one fed to a short
+        # stream is consumed or fails to inflate
+        try:
+            self.inflate.decompress('\0')
+        except zlib.error, e:
+            raise ValidationError('gzip stream truncated: %s' % e)
+        if not self.inflate.unused_data:
+            raise ValidationError('gzip stream truncated before its CRC32 and size trailer')
+
+    def summary(self):
+        return {'tar_members': len(self.members)}
+
+
+# (pattern, validator) for artifacts whose name matches, each download gets a fresh chain through StreamDigest
+artifact_validators = [
+    (r'\.(tar\.gz|tgz)$', TarGzValidator),
+    (r'\.bin$', MagicValidator)
+]
+
+
+def validators_for(item):
+    return [validator for pattern, validator in artifact_validators if re.search(pattern, item)]
+
+
+class StreamDigest(object):
+    """ SHA-256 of a file built from the chunks download() writes, so verifying costs no second read.
+        Chunks at the current position are hashed from memory, chunks ahead of it (other segments, or data
+        already on disk from an earlier attempt) are hashed from the file once the gap before them closes.
+        The same in-order bytes are fed to a fresh instance of each of validators, which raise
+        ValidationError as soon as the data can't be what the artifact claims to be.
+    """
+
+    def __init__(self, path, validators=()):
+        self.path = path
+        self.factories = list(validators)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sha = hashlib.sha256()
+        self.pos = 0
+        self.extents = []
+        self.validators = [factory() for factory in self.factories]
+
+    def consume(self, data):
+        self.sha.update(data)
+        for validator in self.validators:
+            validator.feed(data)
+        self.pos += len(data)
+
+    def update(self, offset, data):
+        with self.lock:
+            if offset == self.pos:
+                self.consume(data)
+            else:
+                self.add_extent(offset, offset + len(data))
+            self.catch_up()
+
+    def written(self, start, end):
+        with self.lock:
+            self.add_extent(start, end)
+            self.catch_up()
+
+    def add_extent(self, start, end):
+        for extent in self.extents:
+            if extent[1] == start:
+                extent[1] = end
+                return
+        self.extents.append([start, end])
+        self.extents.sort()
+
+    def catch_up(self):
+        while self.extents and self.extents[0][0] <= self.pos:
+            start, end = self.extents.pop(0)
+            if end <= self.pos:
+                continue
+            with open(self.path, 'rb') as fh:
+                fh.seek(self.pos)
+                while self.pos < end:
+                    data = fh.read(min(1024 * 1024, end - self.pos))
+                    if not data:
+                        raise IOError('%s is shorter than expected' % self.path)
+                    self.consume(data)
+
+    def hexdigest(self):
+        with self.lock:
+            self.catch_up()
+            return self.sha.hexdigest()
+
+    def finish(self):
+        """ hexdigest() of the complete file once every validator has accepted the end of the stream """
+        with self.lock:
+            self.catch_up()
+            for validator in self.validators:
+                validator.finish()
+            return self.sha.hexdigest()
+
+    def summary(self):
+        result = {}
+        for validator in self.validators:
+            result.update(validator.summary())
+        return result
+
+
+class Manifest(object):
+    """ Known-good size, ETag and SHA-256 of each artifact, grouped by type/release. The first verified download
+        of an artifact is recorded, later downloads must match it. With BW_MANIFEST_KEY set the manifest is
+        signed with HMAC-SHA256 and one that fails the signature check is refused.
+    """
+
+    def __init__(self, path=MANIFEST_FILE, key=MANIFEST_KEY):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        data = read_state(path)
+        self.releases = data.get('releases', {})
+        if key and self.releases and data.get('signature') != self.sign():
+            raise ManifestError('Manifest %s failed signature check' % path)
+
+    def sign(self):
+        return hmac.new(self.key, json.dumps(self.releases, sort_keys=True), hashlib.sha256).hexdigest()
+
+    def get(self, section, item):
+        return self.releases.get(section, {}).get(item)
+
+    def check(self, section, item, entry):
+        with self.lock:
+            known = self.get(section, item)
+            if known and (known['sha256'] != entry['sha256'] or known['size'] != entry['size']):
+                raise ManifestError('%s sha256 %s does not match known-good %s' % (
+                    item, entry['sha256'], known['sha256']))
+            if known != entry:
+                self.releases.setdefault(section, {})[item] = entry
+                self.save()
+
+    def save(self):
+        createDirForFile(self.path)
+        data = {'releases': self.releases}
+        if self.key:
+            data['signature'] = self.sign()
+        write_state(self.path, data)
+
+
+class TransferProgress(object):
+    """ Combined progress line for a set of concurrent transfers, each download() gets its own hook """
+
+    def __init__(self, count):
+        self.count = count
+        self.transfers = {}
+        self.lock = threading.Lock()
+
+    def hook(self, name):
+        def report(bytes_so_far, chunk_size, total_size):
+            with self.lock:
+                self.transfers[name] = (bytes_so_far, total_size)
+                self.render()
+        return report
+
+    def render(self):
+        done = sum(b for b, t in self.transfers.values())
+        total = sum(t for b, t in self.transfers.values())
+        finished = len([b for b, t in self.transfers.values() if b >= t])
+        percent = round(float(done) / total * 100, 2) if total else 0.0
+        sys.stdout.write("Downloaded %d of %d files, %d of %d bytes (%0.2f%%)\r" %
+                         (finished, self.count, done, total, percent))
+        sys.stdout.flush()
+
+    def finish(self):
+        sys.stdout.write('\n')
+
+
+class PooledResponse(object):
+    """ httplib response that hands its connection back to the session pool once the body is fully read """
+
+    def __init__(self, session, key, conn, response):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def getcode(self):
+        return self.response.status
+
+    def info(self):
+        return self.response.msg
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.close()
+        return data
+
+    def readinto(self, b):
+        """ Read into the writable buffer b, returns the number of bytes read, 0 at the end of the body.
+            Python 2 httplib has no readinto so the data is copied in from read() there.
+        """
+        if hasattr(self.response, 'readinto'):
+            n = self.response.readinto(b)
+        else:
+            data = self.response.read(len(b))
+            n = len(data)
+            b[:n] = data
+        if self.response.isclosed():
+            self.close()
+        return n
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.length and not self.response.will_close:
+            self.session.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+
+class XchangeSession(object):
+    """ Keep-alive connection pool per host shared by every Xchange request in the run. The Authorization
+        header is built once, proxy and TLS settings are applied here instead of per request.
+        Without a username no Authorization header is sent, as for LAN peers.
+    """
+
+    def __init__(self, username=XCHANGE_USERNAME, password=XCHANGE_PASSWORD, proxy=XCHANGE_PROXY,
+                 ca_bundle=XCHANGE_CA_BUNDLE, timeout=XCHANGE_TIMEOUT):
+        self.headers = {}
+        if username:
+            self.headers['Authorization'] = 'Basic %s' % base64.b64encode('%s:%s' % (username, password))
+        self.proxy = urlparse.urlsplit(proxy) if proxy else None
+        self.proxy_headers = {}
+        if self.proxy and self.proxy.username:
+            self.proxy_headers['Proxy-Authorization'] = 'Basic %s' % base64.b64encode(
+                '%s:%s' % (urllib2.unquote(self.proxy.username), urllib2.unquote(self.proxy.password or '')))
+        self.context = None
+        if hasattr(ssl, 'create_default_context'):
+            self.context = ssl.create_default_context(cafile=ca_bundle)
+        self.timeout = timeout
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, netloc):
+        with self.lock:
+            pool = self.pools.setdefault((scheme, netloc), [])
+            if pool:
+                return pool.pop(), True
+        kwargs = {'timeout': self.timeout}
+        if scheme == 'https' and self.context:
+            kwargs['context'] = self.context
+        if self.proxy and scheme == 'https':
+            conn = httplib.HTTPSConnection(self.proxy.hostname, self.proxy.port or 8080, **kwargs)
+            host, _, port = netloc.partition(':')
+            conn.set_tunnel(host, int(port or 443), self.proxy_headers)
+        elif self.proxy:
+            conn = httplib.HTTPConnection(self.proxy.hostname, self.proxy.port or 8080, timeout=self.timeout)
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, **kwargs)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def release(self, key, conn):
+        with self.lock:
+            self.pools.setdefault(key, []).append(conn)
+
+    def open(self, url, headers=None, redirects=5):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = url if self.proxy and parts.scheme == 'http' else urlparse.urlunsplit(('', '') + parts[2:])
+        request_headers = dict(self.headers, Host=parts.netloc, **(headers or {}))
+        if self.proxy and parts.scheme == 'http':
+            request_headers.update(self.proxy_headers)
+        while True:
+            conn, reused = self.connect(*key)
+            try:
+                conn.request('GET', path, headers=request_headers)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+        if response.status in (301, 302, 303, 307) and redirects and response.getheader('Location'):
+            response.read()
+            PooledResponse(self, key, conn, response).close()
+            return self.open(urlparse.urljoin(url, response.getheader('Location')), headers, redirects - 1)
+        if response.status >= 400:
+            response.read()
+            PooledResponse(self, key, conn, response).close()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        return PooledResponse(self, key, conn, response)
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                for conn in pool:
+                    conn.close()
+            self.pools = {}
+
+
+def xchange_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = XchangeSession()
+        return session
+
+
+def xchange_open(url, headers=None):
+    return xchange_session().open(url, headers)
+
+
+class PeerSet(object):
+    """ LAN peers running --serve, tried before Xchange. Peers are ranked by the round trip of a listing request
+        on first use, unreachable ones are dropped. Each transfer takes the peer with the fewest transfers in
+        flight, fastest first, that has the artifact, so parallel pulls spread across the peers.
+    """
+
+    def __init__(self, peers, port=PEER_PORT, timeout=PEER_TIMEOUT):
+        self.urls = ['http://%s/' % (p if ':' in p else '%s:%d' % (p, port)) for p in peers]
+        self.session = XchangeSession(username=None, proxy=None, timeout=timeout)
+        self.latency = None
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def open(self, url, headers=None):
+        return self.session.open(url, headers)
+
+    def rank(self):
+        """ Time a listing request to every peer concurrently, keeping those that answer """
+        latency = {}
+
+        def ping(url):
+            try:
+                started = time()
+                self.open(url).read()
+                latency[url] = time() - started
+            except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                logger.warning("\x1b[33mPeer %s unavailable: %s\x1b[0m" % (url, e))
+
+        threads = [threading.Thread(target=ping, args=(url,)) for url in self.urls]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        for url in sorted(latency, key=latency.get):
+            logger.info("\x1b[32mPeer %s responded in %0.1fms\x1b[0m" % (url, latency[url] * 1000))
+        return latency
+
+    def acquire(self, item, exclude=()):
+        """ (peer url, probe result) of the best peer serving item and not in exclude, or (None, None).
+            The peer counts as busy until release()
+        """
+        with self.lock:
+            if self.latency is None:
+                self.latency = self.rank()
+            candidates = sorted((url for url in self.latency if url not in exclude),
+                                key=lambda url: (self.active.get(url, 0), self.latency[url]))
+        for url in candidates:
+            try:
+                remote = probe(url + item, self.open)
+            except urllib2.HTTPError:
+                continue
+            except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                logger.warning("\x1b[33mDropping peer %s: %s\x1b[0m" % (url, e))
+                with self.lock:
+                    self.latency.pop(url, None)
+                continue
+            if remote['size']:
+                with self.lock:
+                    self.active[url] = self.active.get(url, 0) + 1
+                return url, remote
+        return None, None
+
+    def release(self, url):
+        with self.lock:
+            self.active[url] -= 1
+
+
+class PeerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ GET and HEAD of completed artifacts by name with single byte range support, / lists what is served """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, fmt, *args):
+        logger.debug("Peer %s %s" % (self.client_address[0], fmt % args))
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        name = urllib2.unquote(self.path.split('?')[0]).lstrip('/')
+        if not name:
+            return self.reply(200, '\n'.join(self.server.names()) + '\n', body)
+        item = self.server.locate(name)
+        if not item:
+            return self.reply(404, '', body)
+        size = os.path.getsize(item)
+        etag = self.server.etag(name, item, size)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+        if match and (match.group(1) or match.group(2)) and self.headers.get('If-Range', etag) == etag:
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size or start > end:
+                return self.reply(416, '', body, {'Content-Range': 'bytes */%d' % size})
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        with open(item, 'rb') as fh:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = fh.read(min(DOWNLOAD_BUFFER, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def reply(self, code, data, body=True, headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class PeerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ --serve: completed artifacts in dirs, then the newest copy of each in cache_dir, to LAN peers.
+        The ETag sent is the Xchange ETag recorded in the manifest where known, so peers and Xchange
+        share cache entries, manifest trust and partial downloads.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=PEER_PORT, dirs=(INSTALL_DIR,), cache_dir=CACHE_DIR, manifest=MANIFEST_FILE):
+        BaseHTTPServer.HTTPServer.__init__(self, ('', port), PeerRequestHandler)
+        self.dirs = dirs
+        self.cache_dir = cache_dir
+        self.manifest = manifest
+
+    @staticmethod
+    def servable(name):
+        return not name.startswith('.') and not name.endswith(('.part', '.state', '.tmp'))
+
+    def names(self):
+        found = set()
+        for d in self.dirs:
+            if os.path.isdir(d):
+                found.update(f for f in os.listdir(d) if self.servable(f) and os.path.isfile(os.path.join(d, f)))
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            found.update(f for f in os.listdir(self.cache_dir) if self.servable(f))
+        return sorted(found)
+
+    def locate(self, name):
+        """ Path of a complete copy of name, or None """
+        if name != os.path.basename(name) or not self.servable(name):
+            return None
+        for d in self.dirs:
+            if os.path.isfile(os.path.join(d, name)):
+                return os.path.join(d, name)
+        entries = os.path.join(self.cache_dir, name) if self.cache_dir else None
+        if entries and os.path.isdir(entries):
+            copies = [os.path.join(entries, f) for f in os.listdir(entries) if self.servable(f)]
+            if copies:
+                return max(copies, key=os.path.getmtime)
+        return None
+
+    def etag(self, name, item, size):
+        for release in read_state(self.manifest).get('releases', {}).values():
+            known = release.get(name)
+            if known and known['size'] == size and known.get('etag'):
+                return known['etag']
+        return '"%x-%x"' % (size, int(os.path.getmtime(item)))
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+def start_peer_server(port=PEER_PORT, dirs=(INSTALL_DIR,), cache_dir=CACHE_DIR, manifest=MANIFEST_FILE):
+    """ PeerServer running in a daemon thread """
+    server = PeerServer(port, dirs, cache_dir, manifest)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("\x1b[32mServing %s to peers on port %d\x1b[0m" % (
+        ', '.join(d for d in list(dirs) + [cache_dir] if d), port))
+    return server
+
+
+class ListingIndex(object):
+    """ Parsed Xchange directory listings kept on disk with their ETag and Last-Modified. A listing younger
+        than ttl is used as is, one up to stale seconds older is used while a background conditional GET
+        revalidates it, anything older is revalidated before use. A 304 only refreshes the timestamp.
+    """
+
+    def __init__(self, path=LISTING_INDEX, ttl=LISTING_TTL, stale=LISTING_STALE):
+        self.path = path
+        self.ttl = ttl
+        self.stale = stale
+        self.lock = threading.Lock()
+
+    def names(self, url):
+        """ .bin names listed at url """
+        entry = read_state(self.path).get(url)
+        age = time() - entry['fetched'] if entry else None
+        if entry and age < self.ttl:
+            return entry['names']
+        if entry and age < self.ttl + self.stale:
+            refresh = threading.Thread(target=self.refresh, args=(url, entry))
+            refresh.daemon = True
+            refresh.start()
+            return entry['names']
+        try:
+            return self.revalidate(url, entry)['names']
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            if not entry:
+                raise
+            logger.warning("\x1b[33mUsing cached listing of %s, revalidation failed: %s\x1b[0m" % (url, e))
+            return entry['names']
+
+    def refresh(self, url, entry):
+        try:
+            self.revalidate(url, entry)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            logger.warning("\x1b[33mUnable to revalidate listing of %s: %s\x1b[0m" % (url, e))
+
+    def revalidate(self, url, entry=None):
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = str(entry['etag'])
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = str(entry['last_modified'])
+        response = xchange_open(url, headers)
+        data = response.read()
+        if response.getcode() == 304 and entry:
+            entry = dict(entry, fetched=time())
+        else:
+            entry = {'etag': response.info().getheader('ETag'),
+                     'last_modified': response.info().getheader('Last-Modified'),
+                     'fetched': time(), 'names': sorted(set(re.findall(r'[\w.-]+\.bin(?![\w.-])', data)))}
+        with self.lock:
+            try:
+                index = read_state(self.path)
+                index[url] = entry
+                createDirForFile(self.path)
+                write_state(self.path, index)
+            except (IOError, OSError), e:
+                logger.warning("\x1b[33mUnable to save listing index %s: %s\x1b[0m" % (self.path, e))
+        return entry
+
+
+listing_index = ListingIndex()
+
+
+def build_number(name):
+    """ Sort key comparing the digit runs of a name as numbers, eg: swmanager_1003121 > swmanager_549314 """
+    return [int(n) for n in re.findall(r'\d+', name)]
+
+
 def get_latest_swman():
     try:
-        request = urllib2.Request(swm_url)
-        base64string = base64.encodestring('%s:%s' % (XCHANGE_USERNAME, XCHANGE_PASSWORD)).replace('\n', '')
-        request.add_header("Authorization", "Basic %s" % base64string)
-        result = urllib2.urlopen(request)
-        data = result.read()
-        return [x for x in sorted(data.splitlines()) if x.endswith('.bin')][-1]
+        with report.stage('swmanager_listing'):
+            names = listing_index.names(swm_url)
+        return max((x for x in names if x.startswith('swmanager_')), key=build_number)
     except:
         logger.error('\x1b[31mUnable to identify latest software manager version, defaulting to version: 549314\x1b[0m')
         return 'swmanager_549314.bin'
 
 
-def download(base_url, item, save_as=None, chunk_size=8192, report_hook=chunk_report):
-    if save_as:
-        createDirForFile(save_as)
-    request = urllib2.Request(base_url + item)
-    base64string = base64.encodestring('%s:%s' % (XCHANGE_USERNAME, XCHANGE_PASSWORD)).replace('\n', '')
-    request.add_header("Authorization", "Basic %s" % base64string)
-    response = urllib2.urlopen(request)
-    total_size = response.info().getheader('Content-Length').strip()
-    total_size = int(total_size)
-    bytes_so_far = 0
-    fh = open(save_as or item, 'w')
+def read_state(item):
+    try:
+        with open(item) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_state(item, state, sync=False):
+    with open(item + '.tmp', 'w') as fh:
+        json.dump(state, fh)
+        if sync:
+            fh.flush()
+            os.fsync(fh.fileno())
+    os.rename(item + '.tmp', item)
+
+
+def download(base_url, item, save_as=None, chunk_size=DOWNLOAD_CHUNK, report_hook=chunk_report, abort=None,
+             retries=DOWNLOAD_RETRIES, segments=DOWNLOAD_SEGMENTS, cache_dir=CACHE_DIR, manifest=None, section=None,
+             peers=None, opener=xchange_open, priority=None, record=True):
+    """ Fetch base_url + item into save_as, resuming a previous partial transfer where possible.
+        Data is written to save_as.part with the server ETag/size alongside in save_as.part.state and only
+        renamed into place once the byte count matches Content-Length. Dropped connections and 5xx errors are
+        retried with exponential backoff and jitter, resuming with a Range request each time.
+        Files of SEGMENT_THRESHOLD bytes or more are split into `segments` parallel range requests, a .part left
+        by a segmented transfer is resumed in segments, or restarted if the source no longer serves ranges.
+        With a cache_dir, a cached copy with the same name, size and ETag is linked into place instead.
+        The SHA-256 is computed as data arrives and checked against manifest[section] before the file is
+        moved into place, files already matching the manifest size and a non-empty ETag are trusted without
+        rehashing. Without an ETag from the source nothing is trusted on size alone.
+        Data is read through read_blocks() and progress is reported at most every PROGRESS_INTERVAL seconds.
+        With a PeerSet each peer serving item is tried once, falling back to base_url if none of them completes.
+        base_url is opened with opener, eg: an RpmCache session for mirrors that mustn't see Xchange credentials.
+        Every read draws on the shared BandwidthLimiter at priority, priority_for(item) by default.
+        With record False the transfer is left out of report.downloads, for callers that report in aggregate.
+    """
+    save_as = save_as or item
+    createDirForFile(save_as)
+    part = save_as + '.part'
+    report_hook = throttled(report_hook)
+    remote = None
+    digest = StreamDigest(part, validators_for(item))
+    stats = {'source': 'xchange', 'bytes': 0, 'retries': 0, 'started': time(), 'first_byte': None, 'throttled': 0.0}
+    priority = priority_for(item) if priority is None else priority
+    throttle_lock = threading.Lock()
+
+    def throttle(n):
+        waited = bandwidth.consume(n, priority)
+        if waited:
+            with throttle_lock:
+                stats['throttled'] += waited
+    attempt = 0
+    peer = None
+    tried = set()
+    try:
+        while True:
+            try:
+                if remote is None:
+                    if peers:
+                        peer, remote = peers.acquire(item, tried)
+                    url, source_open = (peer + item, peers.open) if peer else (base_url + item, opener)
+                    if peer:
+                        stats['source'] = 'peer %s' % urlparse.urlsplit(peer).netloc
+                    else:
+                        stats['source'] = 'xchange' if opener is xchange_open else urlparse.urlsplit(url).netloc
+                    remote = remote or probe(url, source_open)
+                known = manifest.get(section, item) if manifest else None
+                trusted = bool(known and remote['etag'] and known['size'] == remote['size']
+                               and known['etag'] == remote['etag'])
+                if trusted and os.path.isfile(save_as) and os.path.getsize(save_as) == known['size']:
+                    if report_hook:
+                        report_hook(remote['size'], chunk_size, remote['size'])
+                    logger.info("\x1b[32m%s already matches manifest, skipping download\x1b[0m" % save_as)
+                    stats['source'] = 'manifest'
+                    if record:
+                        report.transfer(item, stats)
+                    return remote['size']
+                entry = cache_entry(cache_dir, item, remote) if cache_dir else None
+                if entry and os.path.isfile(entry):
+                    if manifest and not trusted:
+                        cached = StreamDigest(entry)
+                        cached.written(0, remote['size'])
+                        manifest.check(section, item, {'sha256': cached.hexdigest(), 'size': remote['size'],
+                                                       'etag': remote['etag']})
+                    link_or_copy(entry, save_as)
+                    os.utime(entry, None)
+                    if report_hook:
+                        report_hook(remote['size'], chunk_size, remote['size'])
+                    logger.info("\x1b[32mLinked %s from cache %s\x1b[0m" % (save_as, entry))
+                    stats['source'] = 'cache'
+                    if record:
+                        report.transfer(item, stats)
+                    return remote['size']
+                digest.reset()
+                resuming = os.path.isfile(part)
+                resuming_segments = resuming and bool(read_state(part + '.state').get('segments'))
+                if remote['ranges'] and (resuming_segments or (
+                        segments > 1 and remote['size'] >= SEGMENT_THRESHOLD and not resuming)):
+                    bytes_so_far = fetch_segmented(url, part, segments, chunk_size, report_hook, abort,
+                                                   0 if peer else retries, remote, digest, stats, source_open,
+                                                   throttle)
+                else:
+                    if resuming_segments:
+                        logger.warning("\x1b[33m%s was fetched in segments and %s can't resume it, restarting\x1b[0m"
+                                       % (part, url))
+                        os.remove(part)
+                        os.remove(part + '.state')
+                    bytes_so_far = fetch(url, part, chunk_size, report_hook, abort, digest, stats, source_open,
+                                         throttle)
+                sha256 = digest.finish()
+                break
+            except (DownloadError, urllib2.URLError, httplib.HTTPException, socket.error, IOError), e:
+                if isinstance(e, ValidationError):
+                    logger.error("\x1b[31m%s from %s failed validation: %s\x1b[0m" % (item, url, e))
+                    for leftover in (part, part + '.state'):
+                        if os.path.isfile(leftover):
+                            os.remove(leftover)
+                if peer and not isinstance(e, ManifestError) and not (abort and abort.is_set()):
+                    logger.warning("\x1b[33mPeer %s failed to send %s (%s), trying the next source\x1b[0m" % (
+                        peer, item, e))
+                    peers.release(peer)
+                    tried.add(peer)
+                    peer = remote = None
+                    continue
+                if isinstance(e, DownloadError):
+                    raise
+                if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                    raise DownloadError(e)
+                remote = None
+                attempt += 1
+                stats['retries'] += 1
+                if attempt > retries:
+                    raise DownloadError('gave up after %d attempts: %s' % (attempt, e))
+                delay = min(DOWNLOAD_BACKOFF * 2 ** (attempt - 1), 60) + random.uniform(0, DOWNLOAD_BACKOFF)
+                logger.warning("\x1b[33mDownload of %s interrupted (%s), retry %d/%d in %0.1fs\x1b[0m" % (
+                    item, e, attempt, retries, delay))
+                sleep(delay)
+    finally:
+        if peer:
+            peers.release(peer)
+    stats.update(digest.summary())
+    if manifest:
+        try:
+            manifest.check(section, item, {'sha256': sha256, 'size': bytes_so_far, 'etag': remote['etag']})
+        except ManifestError:
+            os.remove(part)
+            os.remove(part + '.state')
+            raise
+    os.rename(part, save_as)
+    if os.path.isfile(part + '.state'):
+        os.remove(part + '.state')
+    logger.info("\x1b[32mWrote file %s\x1b[0m" % save_as)
+    if record:
+        report.transfer(item, stats)
+    if entry:
+        try:
+            createDirForFile(entry)
+            link_or_copy(save_as, entry)
+            cache_evict(cache_dir)
+        except (OSError, IOError), e:
+            logger.warning("\x1b[33mUnable to cache %s: %s\x1b[0m" % (save_as, e))
+    return bytes_so_far
+
+
+def probe(url, opener=xchange_open):
+    """ One byte range request to learn the size, ETag and range support of url without fetching it """
+    response = opener(url, {'Range': 'bytes=0-0'})
+    content_range = response.info().getheader('Content-Range')
+    if response.getcode() == 206 and content_range:
+        response.read()
+        size = int(content_range.split('/')[-1])
+    else:
+        size = int(response.info().getheader('Content-Length', '0').strip() or 0)
+    response.close()
+    return {'size': size, 'etag': response.info().getheader('ETag'),
+            'ranges': response.getcode() == 206 and bool(content_range)}
+
+
+def cache_entry(cache_dir, item, remote):
+    """ Cache path for an artifact, keyed by name plus the server size and ETag. None if it can't be keyed """
+    if not remote['size']:
+        return None
+    key = hashlib.sha1('%d:%s' % (remote['size'], remote['etag'] or '')).hexdigest()[:16]
+    return os.path.join(cache_dir, item, '%d-%s' % (remote['size'], key))
+
+
+def link_or_copy(src, dst):
+    """ Hardlink src to dst, falling back to a reflink then a plain copy across filesystems """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        with open(src, 'rb') as fin:
+            with open(tmp, 'wb') as fout:
+                try:
+                    fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                except IOError:
+                    shutil.copyfileobj(fin, fout, 1024 * 1024)
+    os.rename(tmp, dst)
+
+
+def cache_evict(cache_dir, max_size=CACHE_MAX_SIZE):
+    """ Remove least recently used cache entries until the cache fits in max_size bytes """
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        for f in files:
+            st = os.stat(os.path.join(root, f))
+            entries.append((st.st_mtime, st.st_size, os.path.join(root, f)))
+    total = sum(e[1] for e in entries)
+    for mtime, size, item in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(item)
+            total -= size
+            logger.info("\x1b[32mEvicted %s from cache\x1b[0m" % item)
+        except OSError:
+            pass
+
+
+def throttled(report_hook, interval=PROGRESS_INTERVAL):
+    """ Wrap report_hook so it runs at most once per interval, and always for the final byte of a transfer """
+    if not report_hook:
+        return None
+    last = [0]
+
+    def hook(bytes_so_far, chunk_size, total_size):
+        now = time()
+        if now - last[0] >= interval or bytes_so_far >= total_size:
+            last[0] = now
+            report_hook(bytes_so_far, chunk_size, total_size)
+    return hook
+
+
+def parse_rate(text):
+    """ Bytes per second from eg: 512K, 2M or 1.5G, 0 or off for no limit """
+    if text.strip().lower() in ('off', 'none', 'unlimited'):
+        return 0
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', text, re.I)
+    if not match:
+        raise ValueError('bad rate %r' % text)
+    return int(float(match.group(1)) * {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[match.group(2).upper()])
+
+
+def parse_schedule(spec):
+    """ ([(start minute, end minute, rate)], default rate) from a rate or comma separated HH:MM-HH:MM=RATE
+        windows with an optional bare default rate, eg: '08:00-18:00=2M,0'. Windows may wrap past midnight.
+    """
+    windows, default = [], 0
+    for entry in [e.strip() for e in spec.split(',') if e.strip()]:
+        times, sep, rate = entry.rpartition('=')
+        if not sep:
+            default = parse_rate(rate)
+            continue
+        match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', times.strip())
+        if not match:
+            raise ValueError('bad time window %r' % times)
+        h1, m1, h2, m2 = [int(g) for g in match.groups()]
+        windows.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(rate)))
+    return windows, default
+
+
+def scheduled_rate(schedule, when=None):
+    windows, default = schedule
+    now = localtime(when)
+    minute = now.tm_hour * 60 + now.tm_min
+    for start, end, rate in windows:
+        if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+            return rate
+    return default
+
+
+def format_rate(rate):
+    return '%0.1f KB/s' % (rate / 1024.0) if rate else 'unlimited'
+
+
+class BandwidthLimiter(object):
+    """ Token bucket every download() draws from, so parallel and segmented transfers share one cap. The cap
+        follows a schedule from --bandwidth, eg: '08:00-18:00=2M,0' for 2 MB/s in office hours and no limit
+        otherwise, unless the control file holds one. The file is re-read when it changes or on SIGUSR1.
+        While the cap is reached, the waiting transfer with the lowest priority number goes first.
+    """
+
+    def __init__(self, spec='0', control_file=None):
+        self.cond = threading.Condition()
+        self.waiting = {}
+        self.tokens = 0.0
+        self.stamp = time()
+        self.rate = None
+        self.changes = []
+        self.priorities = {}
+        self.configure(spec, control_file)
+
+    def configure(self, spec=None, control_file=None):
+        """ Apply the schedule spec, BW_BANDWIDTH when it's None, raises ValueError if it doesn't parse """
+        if spec is None:
+            spec = BANDWIDTH
+        with self.cond:
+            self.spec = spec
+            self.schedule = parse_schedule(spec)
+            self.control_file = control_file
+            self.override = None
+            self.reload()
+
+    def reload(self):
+        """ Re-read the control file and the schedule now instead of within BANDWIDTH_RECHECK """
+        with self.cond:
+            self.checked = 0
+            self.mtime = None
+            self.refresh(time())
+            self.cond.notify_all()
+
+    def refresh(self, now):
+        if now - self.checked < BANDWIDTH_RECHECK:
+            return
+        self.checked = now
+        if self.control_file:
+            try:
+                mtime = os.path.getmtime(self.control_file)
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self.override = None
+                if mtime is not None:
+                    try:
+                        with open(self.control_file) as fh:
+                            spec = fh.read().strip()
+                        self.override = parse_schedule(spec) if spec else None
+                    except (IOError, ValueError), e:
+                        logger.warning("\x1b[33mIgnoring bandwidth control file %s: %s\x1b[0m" % (
+                            self.control_file, e))
+        rate = scheduled_rate(self.override or self.schedule, now)
+        if rate != self.rate:
+            if rate or self.rate:
+                logger.info("\x1b[32mBandwidth limit %s\x1b[0m" % format_rate(rate))
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * BANDWIDTH_BURST)
+            self.changes.append({'offset': round(now - report.started, 3), 'limit': rate})
+
+    def consume(self, n, priority=0):
+        """ Take n bytes of tokens, waiting while the bucket is empty or a transfer with a lower priority number
+            is waiting too. The bucket may go into debt for a large n, later takers wait it off. Returns the
+            seconds spent waiting.
+        """
+        started = time()
+        with self.cond:
+            self.waiting[priority] = self.waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    now = time()
+                    self.refresh(now)
+                    if not self.rate:
+                        break
+                    self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.rate * BANDWIDTH_BURST)
+                    self.stamp = now
+                    if self.tokens > 0 and priority <= min(p for p, count in self.waiting.items() if count):
+                        self.tokens -= n
+                        break
+                    self.cond.wait(min(max(-self.tokens / self.rate, 0.01), BANDWIDTH_RECHECK))
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+            waited = time() - started
+            stats = self.priorities.setdefault(priority, {'bytes': 0, 'throttled_seconds': 0.0})
+            stats['bytes'] += n
+            stats['throttled_seconds'] += waited
+        return waited
+
+    def summary(self):
+        with self.cond:
+            priorities = dict((priority, {'bytes': stats['bytes'],
+                                          'throttled_seconds': round(stats['throttled_seconds'], 3)})
+                              for priority, stats in self.priorities.items())
+            return {'limit': self.rate, 'schedule': self.spec, 'control_file': self.control_file,
+                    'changes': list(self.changes), 'priorities': priorities}
+
+
+# (pattern, priority) for bandwidth while limited, lower goes first, anything else gets TRANSFER_PRIORITY
+transfer_priorities = [
+    (r'_Rel_', 0),
+    (r'^IP\.', 1),
+    (r'^swmanager_', 2)
+]
+TRANSFER_PRIORITY = 3
+
+
+def priority_for(item):
+    for pattern, priority in transfer_priorities:
+        if re.search(pattern, item):
+            return priority
+    return TRANSFER_PRIORITY
+
+
+# unlimited until main() configures it, so a malformed BW_BANDWIDTH is an option error rather than an import error
+bandwidth = BandwidthLimiter()
+
+
+def read_blocks(response, chunk_size, buffer_size=DOWNLOAD_BUFFER, throttle=None):
+    """ Read response into one reusable buffer, yielding a memoryview of the filled part whenever the buffer is
+        full, the body ends or PROGRESS_INTERVAL has passed. The view is only valid until the next iteration.
+        Reads start at chunk_size and double or halve to take about CHUNK_TARGET seconds each, so a fast link
+        makes a few large reads per buffer and a slow one still checks in regularly.
+        throttle(n) is called after every read, eg: to wait on the BandwidthLimiter.
+    """
+    view = memoryview(bytearray(buffer_size))
+    filled = 0
+    flushed = time()
     while 1:
-        chunk = response.read(chunk_size)
-        fh.write(chunk)
-        bytes_so_far += len(chunk)
-        if not chunk:
+        size = min(chunk_size, buffer_size - filled)
+        started = time()
+        n = response.readinto(view[filled:filled + size])
+        now = time()
+        filled += n
+        if throttle and n:
+            throttle(n)
+        if n == size and now - started < CHUNK_TARGET / 2:
+            chunk_size = min(chunk_size * 2, buffer_size)
+        elif now - started > CHUNK_TARGET * 2:
+            chunk_size = max(chunk_size // 2, 4096)
+        if filled and (not n or filled == buffer_size or now - flushed >= PROGRESS_INTERVAL):
+            yield view[:filled]
+            filled = 0
+            flushed = now
+        if not n:
             break
+
+
+def fetch_segmented(url, part, segments, chunk_size, report_hook, abort, retries, remote, digest, stats,
+                    opener=xchange_open, throttle=None):
+    """ Fetch url into part as concurrent byte range segments written straight to their offsets in a
+        preallocated file. Segment progress is kept in part.state so a failed segment, or a later run,
+        only refetches what is missing.
+    """
+    state = read_state(part + '.state')
+    if not state.get('segments') or not os.path.isfile(part):
+        size = remote['size']
+        step = size // segments + 1
+        state = {'etag': remote['etag'], 'size': size,
+                 'segments': [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]}
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        write_state(part + '.state', state)
+    size = state['size']
+    for segment in state['segments']:
+        digest.written(segment[0], segment[0] + segment[2])
+    lock = threading.Lock()
+    failed = threading.Event()
+    errors = []
+
+    def progress():
         if report_hook:
-            report_hook(bytes_so_far, chunk_size, total_size)
-    fh.close()
-    logger.info("\x1b[32mWrote file %s\x1b[0m" % save_as)
+            report_hook(sum(s[2] for s in state['segments']), chunk_size, size)
+
+    def worker(segment):
+        fd = os.open(part, os.O_WRONLY)
+        attempt = 0
+        try:
+            while segment[0] + segment[2] <= segment[1] and not failed.is_set():
+                try:
+                    offset = segment[0] + segment[2]
+                    headers = {'Range': 'bytes=%d-%d' % (offset, segment[1])}
+                    if state.get('etag'):
+                        headers['If-Range'] = state['etag']
+                    response = opener(url, headers)
+                    content_range = response.info().getheader('Content-Range') or ''
+                    if response.getcode() != 206 or not content_range.startswith('bytes %d-' % offset):
+                        raise DownloadError('server copy changed during segmented download')
+                    saved = segment[2]
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    for chunk in read_blocks(response, chunk_size, throttle=throttle):
+                        os.write(fd, chunk)
+                        digest.update(segment[0] + segment[2], chunk)
+                        with lock:
+                            segment[2] += len(chunk)
+                            stats['bytes'] += len(chunk)
+                            if stats['first_byte'] is None:
+                                stats['first_byte'] = time() - stats['started']
+                            if segment[2] - saved >= SEGMENT_CHECKPOINT:
+                                saved = segment[2]
+                                write_state(part + '.state', state)
+                            progress()
+                        if failed.is_set() or (abort and abort.is_set()):
+                            raise DownloadError('aborted')
+                    if segment[0] + segment[2] <= segment[1]:
+                        raise IOError('Short transfer in segment %d-%d' % (segment[0], segment[1]))
+                except (urllib2.URLError, httplib.HTTPException, socket.error, IOError), e:
+                    if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                        raise DownloadError(e)
+                    attempt += 1
+                    with lock:
+                        stats['retries'] += 1
+                    if attempt > retries:
+                        raise DownloadError('segment %d-%d gave up after %d attempts: %s' % (
+                            segment[0], segment[1], attempt, e))
+                    delay = min(DOWNLOAD_BACKOFF * 2 ** (attempt - 1), 60) + random.uniform(0, DOWNLOAD_BACKOFF)
+                    logger.warning("\x1b[33mSegment %d-%d of %s interrupted (%s), retry %d/%d in %0.1fs\x1b[0m" % (
+                        segment[0], segment[1], url, e, attempt, retries, delay))
+                    sleep(delay)
+        except Exception, e:
+            errors.append(e)
+            failed.set()
+        finally:
+            os.close(fd)
+
+    threads = [threading.Thread(target=worker, args=(s,)) for s in state['segments'] if s[0] + s[2] <= s[1]]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(0.5)
+    with lock:
+        write_state(part + '.state', state)
+    if errors:
+        if [e for e in errors if 'server copy changed' in str(e)]:
+            os.remove(part)
+            os.remove(part + '.state')
+            raise IOError('Server copy of %s changed, restarting' % url)
+        raise errors[0]
+    return size
+
+
+def fetch(url, part, chunk_size, report_hook, abort, digest, stats, opener=xchange_open, throttle=None):
+    """ Single transfer attempt for download(), returns the size of part once complete """
+    state = read_state(part + '.state')
+    stream_part = os.path.isfile(part) and state.get('size') and not state.get('segments')
+    offset = os.path.getsize(part) if stream_part else 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+        if state.get('etag'):
+            headers['If-Range'] = state['etag']
+    try:
+        response = opener(url, headers)
+    except urllib2.HTTPError, e:
+        if e.code != 416:
+            raise
+        if offset == state.get('size'):
+            digest.written(0, offset)
+            return offset
+        os.remove(part)
+        raise IOError('Partial file %s does not match server copy, restarting' % part)
+    etag = response.info().getheader('ETag')
+    content_range = response.info().getheader('Content-Range')
+    if response.getcode() == 206 and content_range:
+        start, total_size = re.match(r'bytes (\d+)-\d+/(\d+)', content_range).groups()
+        if int(start) != offset or int(total_size) != state.get('size') or (etag and etag != state.get('etag')):
+            os.remove(part)
+            raise IOError('Server copy of %s changed, restarting' % url)
+        total_size = int(total_size)
+        digest.written(0, offset)
+        fh = open(part, 'ab', DOWNLOAD_BUFFER)
+    else:
+        if offset:
+            logger.warning("\x1b[33mServer ignored range request, fetching %s in full\x1b[0m" % url)
+        offset = 0
+        total_size = int(response.info().getheader('Content-Length', '0').strip() or 0)
+        write_state(part + '.state', {'etag': etag, 'size': total_size})
+        fh = open(part, 'wb', DOWNLOAD_BUFFER)
+    bytes_so_far = offset
+    try:
+        for chunk in read_blocks(response, chunk_size, throttle=throttle):
+            fh.write(chunk)
+            digest.update(bytes_so_far, chunk)
+            bytes_so_far += len(chunk)
+            stats['bytes'] += len(chunk)
+            if stats['first_byte'] is None:
+                stats['first_byte'] = time() - stats['started']
+            if report_hook:
+                report_hook(bytes_so_far, chunk_size, total_size)
+            if abort and abort.is_set():
+                raise DownloadError('aborted')
+    finally:
+        fh.close()
+    if total_size and bytes_so_far != total_size:
+        raise IOError('Short transfer, got %d of %d bytes' % (bytes_so_far, total_size))
     return bytes_so_far
 
 
+def release_downloads(result):
+    """ (label, base_url, item) download jobs for a type/release picked by opts() or menu() """
+    return [('installer', bss_url.replace('__RELEASE__', result.get('release')), result.get('installer')),
+            ('patch', ips_url.replace('__RELEASE__', result.get('release')), result.get('patch')),
+            ('swmanager', swm_url, get_latest_swman)]
+
+
+def download_stages(jobs, path, concurrency=DOWNLOAD_CONCURRENCY, segments=DOWNLOAD_SEGMENTS, cache_dir=CACHE_DIR,
+                    manifest=None, section=None, abort=None, peers=None):
+    """ One 'download:<label>' Stage per (label, base_url, item) job, sharing a concurrency limit and a combined
+        progress line. item may be a callable returning the name to fetch, eg: get_latest_swman, it is resolved
+        inside the stage so listing round-trips overlap with the other transfers. Each stage returns the name
+        it fetched. Returns the stages and their TransferProgress.
+    """
+    slots = threading.BoundedSemaphore(max(1, concurrency))
+    progress = TransferProgress(len(jobs))
+
+    def fetcher(base_url, item):
+        def run(results):
+            with slots:
+                name = item() if callable(item) else item
+                download(base_url, name, "%s%s" % (path, name), report_hook=progress.hook(name), abort=abort,
+                         segments=segments, cache_dir=cache_dir, manifest=manifest, section=section, peers=peers)
+                return name
+        return run
+
+    return [Stage('download:%s' % label, fetcher(base_url, item),
+                  inputs={'url': base_url, 'item': None if callable(item) else item},
+                  verify=lambda name: os.path.isfile("%s%s" % (path, name)))
+            for label, base_url, item in jobs], progress
+
+
+def download_all(jobs, path, concurrency=DOWNLOAD_CONCURRENCY, segments=DOWNLOAD_SEGMENTS, cache_dir=CACHE_DIR,
+                 manifest=None, section=None, peers=None):
+    """ Download a set of (label, base_url, item) jobs into path in parallel, at most concurrency at a time.
+        If any transfer fails the rest are aborted, leaving their .part files for a later resume, and
+        DownloadError is raised. Returns the fetched names in job order.
+    """
+    abort = threading.Event()
+    stages, progress = download_stages(jobs, path, concurrency, segments, cache_dir, manifest, section, abort, peers)
+    try:
+        results = run_stages(stages, abort)
+    except StageError, e:
+        raise DownloadError('%d of %d downloads failed' % (len(e.errors), len(jobs)))
+    finally:
+        progress.finish()
+    return [results[stage.name] for stage in stages]
+
+
+class StageError(Exception):
+    def __init__(self, errors):
+        Exception.__init__(self, ', '.join('%s: %s' % (name, e) for name, e in errors))
+        self.errors = errors
+
+
+class Stage(object):
+    """ A named step of the bootstrap, func(results) runs once every stage named in deps has succeeded.
+        inputs identify the work for the StateJournal and verify(output) says whether a result is complete,
+        and still is when resuming, eg: the file it wrote exists.
+    """
+
+    def __init__(self, name, func, deps=(), inputs=None, verify=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.verify = verify or (lambda output: True)
+        self.finished = threading.Event()
+
+
+def run_stages(stages, abort=None, journal=None):
+    """ Run a dependency graph of Stages, each in its own thread as soon as its deps are done, so independent
+        stages overlap and the total time approaches the longest chain. The first failure sets abort, stages
+        not yet started are skipped and StageError is raised once everything has stopped.
+        With a StateJournal, stages it holds as complete for the same inputs and dep results are skipped and
+        each newly completed stage is recorded. Returns a dict of stage name to func result.
+    """
+    abort = abort or threading.Event()
+    by_name = dict((stage.name, stage) for stage in stages)
+    visiting, visited = set(), set()
+
+    def visit(stage):
+        if stage.name in visiting:
+            raise ValueError('Stage dependency cycle at %s' % stage.name)
+        if stage.name not in visited:
+            visiting.add(stage.name)
+            for dep in stage.deps:
+                if dep not in by_name:
+                    raise ValueError('Stage %s depends on unknown stage %s' % (stage.name, dep))
+                visit(by_name[dep])
+            visiting.remove(stage.name)
+            visited.add(stage.name)
+
+    for stage in stages:
+        visit(stage)
+    results = {}
+    errors = []
+
+    def runner(stage):
+        try:
+            for dep in stage.deps:
+                by_name[dep].finished.wait()
+            if abort.is_set() or [dep for dep in stage.deps if dep not in results]:
+                return
+            inputs = {'inputs': stage.inputs, 'deps': dict((dep, results[dep]) for dep in stage.deps)}
+            entry = journal.completed(stage, inputs) if journal else None
+            if entry:
+                logger.info("\x1b[32mStage %s already complete, skipping\x1b[0m" % stage.name)
+                report.skip(stage.name)
+                results[stage.name] = entry['output']
+                return
+            with report.stage(stage.name):
+                results[stage.name] = stage.func(results)
+            if journal and stage.verify(results[stage.name]):
+                journal.record(stage.name, inputs, results[stage.name])
+        except Exception, e:
+            if not isinstance(e, DownloadError) or not abort.is_set():
+                logger.error("\x1b[31mStage %s failed: %s\x1b[0m" % (stage.name, e))
+                errors.append((stage.name, e))
+            abort.set()
+        finally:
+            stage.finished.set()
+
+    threads = [threading.Thread(target=runner, args=(stage,)) for stage in stages]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while [t for t in threads if t.is_alive()]:
+            for t in threads:
+                t.join(0.5)
+    except KeyboardInterrupt:
+        abort.set()
+        raise
+    if errors:
+        raise StageError(errors)
+    return results
+
+
+class StateJournal(object):
+    """ Completed stages of a bootstrap with their inputs and outputs, rewritten and fsynced after each one so a
+        rerun, or the resume unit after a reboot, carries on from the first incomplete stage. The journal
+        belongs to one type/release, starting another discards it.
+    """
+
+    def __init__(self, path=STATE_FILE, run=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = read_state(path)
+        if run is not None and self.data.get('run') != run:
+            self.data = {'run': run}
+        self.data.setdefault('stages', {})
+
+    def completed(self, stage, inputs):
+        """ The journal entry for stage if it finished with the same inputs and its output still verifies """
+        with self.lock:
+            entry = self.data['stages'].get(stage.name)
+        if entry and entry['inputs'] == json.loads(json.dumps(inputs)) and stage.verify(entry['output']):
+            return entry
+        return None
+
+    def record(self, name, inputs, output):
+        with self.lock:
+            self.data['stages'][name] = json.loads(json.dumps({'inputs': inputs, 'output': output,
+                                                               'finished': time()}))
+            self.save()
+
+    def set(self, key, value):
+        with self.lock:
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+            self.save()
+
+    def save(self):
+        createDirForFile(self.path)
+        write_state(self.path, self.data, sync=True)
+
+
+def arm_resume(journal, args):
+    """ Save args in the journal and install a one-shot boot unit running --resume with them, a systemd service
+        where systemd is running or a chkconfig init script otherwise
+    """
+    journal.set('resume', args)
+    command = '%s %s --resume --state=%s' % (sys.executable, os.path.abspath(__file__), journal.path)
+    if os.path.isdir('/run/systemd/system'):
+        with open('/etc/systemd/system/%s.service' % RESUME_UNIT, 'w') as fh:
+            fh.write('[Unit]\nDescription=Resume Broadworks bootstrap after reboot\n'
+                     'After=network-online.target\nWants=network-online.target\n\n'
+                     '[Service]\nType=oneshot\nExecStart=%s\nTimeoutSec=0\nStandardOutput=journal+console\n\n'
+                     '[Install]\nWantedBy=multi-user.target\n' % command)
+        rc = subprocess.Popen('systemctl daemon-reload && systemctl enable %s.service' % RESUME_UNIT,
+                              shell=True).wait()
+    else:
+        with open('/etc/init.d/%s' % RESUME_UNIT, 'w') as fh:
+            fh.write('#!/bin/sh\n# chkconfig: 345 99 01\n# description: Resume Broadworks bootstrap after reboot\n'
+                     '[ "$1" = start ] || exit 0\nmkdir -p /var/log/bwbootstrap\n'
+                     '%s >> /var/log/bwbootstrap/resume.log 2>&1 &\n' % command)
+        setExecute('/etc/init.d/%s' % RESUME_UNIT)
+        rc = subprocess.Popen('/sbin/chkconfig --add %s' % RESUME_UNIT, shell=True).wait()
+    if rc:
+        raise OSError('Unable to enable %s boot unit' % RESUME_UNIT)
+
+
+def disarm_resume(journal):
+    """ Remove the resume unit, and the .bashrc autolaunch line older versions used """
+    journal.set('resume', None)
+    if os.path.isfile('/etc/systemd/system/%s.service' % RESUME_UNIT):
+        subprocess.Popen('systemctl disable %s.service' % RESUME_UNIT, shell=True).wait()
+        os.remove('/etc/systemd/system/%s.service' % RESUME_UNIT)
+    if os.path.isfile('/etc/init.d/%s' % RESUME_UNIT):
+        subprocess.Popen('/sbin/chkconfig --del %s' % RESUME_UNIT, shell=True).wait()
+        os.remove('/etc/init.d/%s' % RESUME_UNIT)
+    if os.path.isfile('/root/.bashrc'):
+        subprocess.Popen("sed -i '/python \/root\/bwbootstrap.py/d' /root/.bashrc", shell=True).wait()
+
+
 def createDirForFile(item):
     if '/' not in item:
         return
@@ -457,38 +2250,485 @@ def setExecute(item):
         logger.error("\x1b[31m%s\x1b[0m" % e)
 
 
-def configure_os():
-    while True:
-        ans = raw_input("Do you wish to pre-configure the OS and reboot? [y/n]: ").lower()
-        if ans == 'n':
-            break
-        if ans != 'y':
+class Bundle(object):
+    """ Single file holding everything to install a release offline. Layout: BUNDLE_MAGIC, the index length as
+        a big-endian uint64, the JSON index, then the member data. The index sits at the front, padded to the
+        space reserved for it, and lists each member's kind, offset from the start of the data, size and
+        SHA-256, so members are read straight out of the archive without unpacking it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            if fh.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+                raise IOError('%s is not a bwbootstrap bundle' % path)
+            length = struct.unpack('>Q', fh.read(8))[0]
+            self.index = json.loads(fh.read(length))
+        self.data_offset = len(BUNDLE_MAGIC) + 8 + length
+        self.members = OrderedDict((m['name'], m) for m in self.index['members'])
+
+    def kind(self, kind):
+        return [m for m in self.members.values() if m['kind'] == kind]
+
+    def extract(self, name, save_as):
+        """ Copy one member to save_as through a .part file, verifying its SHA-256 on the way """
+        member = self.members[name]
+        createDirForFile(save_as)
+        sha = hashlib.sha256()
+        with open(self.path, 'rb') as fin:
+            fin.seek(self.data_offset + member['offset'])
+            with open(save_as + '.part', 'wb') as fout:
+                remaining = member['size']
+                while remaining:
+                    data = fin.read(min(DOWNLOAD_BUFFER, remaining))
+                    if not data:
+                        raise IOError('%s is truncated in member %s' % (self.path, name))
+                    sha.update(data)
+                    fout.write(data)
+                    remaining -= len(data)
+        if sha.hexdigest() != member['sha256']:
+            os.remove(save_as + '.part')
+            raise ManifestError('%s sha256 %s does not match bundle index %s' % (
+                name, sha.hexdigest(), member['sha256']))
+        os.rename(save_as + '.part', save_as)
+        return save_as
+
+    def extract_repo(self, repo_dir):
+        """ Extract the bundled RPMs and repodata into repo_dir for use as a local yum repo """
+        for member in self.kind('rpm') + self.kind('repodata'):
+            save_as = os.path.join(repo_dir, member['name'].split('/', 1)[1])
+            if not os.path.isfile(save_as) or os.path.getsize(save_as) != member['size']:
+                self.extract(member['name'], save_as)
+        logger.info("\x1b[32mExtracted %d bundled RPMs to %s\x1b[0m" % (len(self.kind('rpm')), repo_dir))
+        return repo_dir
+
+    @staticmethod
+    def pack(path, info, members):
+        """ Write a bundle of (name, kind, source path) members. The data is streamed in once, hashing as it goes,
+            and the index is written into the space reserved for it at the front afterwards.
+        """
+        reserved = 4096 + 512 * len(members)
+        index = dict(info, members=[])
+        createDirForFile(path)
+        with open(path + '.part', 'wb') as fout:
+            fout.write(BUNDLE_MAGIC + struct.pack('>Q', reserved) + ' ' * reserved)
+            offset = 0
+            for name, kind, source in members:
+                sha = hashlib.sha256()
+                with open(source, 'rb') as fin:
+                    while True:
+                        data = fin.read(DOWNLOAD_BUFFER)
+                        if not data:
+                            break
+                        sha.update(data)
+                        fout.write(data)
+                size = fout.tell() - len(BUNDLE_MAGIC) - 8 - reserved - offset
+                index['members'].append({'name': name, 'kind': kind, 'offset': offset, 'size': size,
+                                         'sha256': sha.hexdigest()})
+                offset += size
+            data = json.dumps(index)
+            if len(data) > reserved:
+                raise IOError('Bundle index of %d bytes overflows the %d reserved' % (len(data), reserved))
+            fout.seek(len(BUNDLE_MAGIC) + 8)
+            fout.write(data)
+        os.rename(path + '.part', path)
+        logger.info("\x1b[32mWrote bundle %s, %d members, %d bytes\x1b[0m" % (path, len(members), offset))
+
+
+def bundle_stages(bundle, path):
+    """ 'download:<label>' Stages taking each artifact from a Bundle instead of Xchange """
+    def extractor(member):
+        def run(results):
+            bundle.extract(member['name'], "%s%s" % (path, member['name']))
+            return member['name']
+        return run
+
+    return [Stage('download:%s' % member['kind'], extractor(member),
+                  inputs={'bundle': bundle.path, 'sha256': member['sha256']},
+                  verify=lambda name: os.path.isfile("%s%s" % (path, name)))
+            for member in bundle.members.values() if member['kind'] in ('installer', 'patch', 'swmanager')]
+
+
+def download_rpms(wanted, rpm_dir):
+    """ yum downloadonly every entry of wanted into rpm_dir, reinstall --downloadonly for the ones already
+        installed here so the set is complete for a fresh host, then createrepo it. Returns the RPM paths.
+    """
+    installed = installed_packages()
+    for verb, names in (('install', [p for p in wanted if p not in installed]),
+                        ('reinstall', [p for p in wanted if p in installed])):
+        if names:
+            rc = subprocess.Popen(['yum', '-y', verb, '--downloadonly', '--downloaddir=%s' % rpm_dir] + names).wait()
+            if rc:
+                logger.warning("\x1b[33myum %s --downloadonly exited with %d\x1b[0m" % (verb, rc))
+    rpms = [os.path.join(rpm_dir, f) for f in sorted(os.listdir(rpm_dir)) if f.endswith('.rpm')]
+    if not rpms:
+        raise OSError('yum downloaded no RPMs, is the downloadonly plugin installed?')
+    if subprocess.Popen(['createrepo', '-q', rpm_dir]).wait():
+        raise OSError('createrepo %s failed' % rpm_dir)
+    return rpms
+
+
+def build_bundle(result, o):
+    """ --bundle: fetch a release's artifacts and RPMs and pack them with a placeholder unattended.conf """
+    section = '%s/%s' % (result.get('type'), result.get('release'))
+    workdir = tempfile.mkdtemp(prefix='.bwbundle', dir=os.path.dirname(os.path.abspath(o.bundle)))
+    try:
+        with report.stage('bundle:download'):
+            jobs = release_downloads(result)
+            names = download_all(jobs, workdir + '/', o.concurrency, o.segments, o.cache_dir, Manifest(o.manifest),
+                                 section, PeerSet(o.peers, o.port) if o.peers else None)
+        members = [(name, job[0], os.path.join(workdir, name)) for job, name in zip(jobs, names)]
+        with report.stage('bundle:rpms'):
+            os.makedirs(os.path.join(workdir, 'rpms'))
+            rpms = download_rpms(packages, os.path.join(workdir, 'rpms'))
+        members += [('rpms/%s' % os.path.basename(rpm), 'rpm', rpm) for rpm in rpms]
+        repodata = os.path.join(workdir, 'rpms', 'repodata')
+        members += [('rpms/repodata/%s' % f, 'repodata', os.path.join(repodata, f))
+                    for f in sorted(os.listdir(repodata))]
+        createUnattenededInstallConfig(os.path.join(workdir, 'unattended.conf'), result.get('options'), identity={})
+        members.append(('unattended.conf', 'config', os.path.join(workdir, 'unattended.conf')))
+        with report.stage('bundle:pack'):
+            Bundle.pack(o.bundle, {'type': result.get('type'), 'release': result.get('release'), 'created': time()},
+                        members)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def find_executable(name):
+    """ Path of name on PATH, None if it isn't installed """
+    for directory in os.getenv('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def installed_packages():
+    """ NAME.ARCH of every installed RPM from a single rpm query """
+    output = subprocess.Popen(['rpm', '-qa', '--qf', '%{NAME}.%{ARCH}\n'], stdout=subprocess.PIPE).communicate()[0]
+    return set(output.split())
+
+
+def repo_gpgkeys(exclude=(), repos_dir='/etc/yum.repos.d'):
+    """ gpgkey URLs of the enabled repos in repos_dir, less the ones named in exclude, so a local repo of RPMs
+        fetched from them checks signatures against the same keys
+    """
+    keys = []
+    parser = ConfigParser.RawConfigParser()
+    try:
+        parser.read([os.path.join(repos_dir, f) for f in sorted(os.listdir(repos_dir))
+                     if f.endswith('.repo') and f[:-len('.repo')] not in exclude])
+    except (OSError, ConfigParser.Error), e:
+        logger.warning("\x1b[33mUnable to read the gpgkeys in %s: %s\x1b[0m" % (repos_dir, e))
+        return keys
+    for section in parser.sections():
+        if section in exclude or not parser.has_option(section, 'gpgkey'):
             continue
-        logger.info("\x1b[32mDisabling selinux\x1b[0m")
-        subprocess.Popen('sed -i.orig -e s/SELINUX=.*$/SELINUX=disabled/g /etc/selinux/config', shell=True).wait()
-        sleep(0.5)
-        logger.info("\x1b[32mChanging snmpd OID\x1b[0m")
-        subprocess.Popen('sed -i.orig -e s/.1.3.6.1.2.1.1/.1.3.6.1.2.1/g /etc/snmp/snmpd.conf', shell=True).wait()
-        sleep(0.5)
-        logger.info("\x1b[32mUpdating sysstat collection to every 5 minuets\x1b[0m")
-        subprocess.Popen(
-            "sed -i.orig 's|\*/[0-9]\+ \* \* \* \* root /usr/lib64/sa/sa1|\*/5 \* \* \* \* root /usr/lib64/sa/sa1|g' /etc/cron.d/sysstat",
-            shell=True).wait()
-        sleep(0.5)
-        logger.info("\x1b[32mAdding snmpd to 3 4 5 runlevels\x1b[0m")
-        subprocess.Popen(
-            '/sbin/chkconfig --add snmpd; /sbin/chkconfig --level 345 snmpd resetpriorities; /etc/init.d/snmpd start',
-            shell=True).wait()
-        sleep(0.5)
-        logger.info("\x1b[32mDisabling iptables\x1b[0m")
-        subprocess.Popen('/etc/init.d/iptables stop; /sbin/chkconfig iptables off', shell=True).wait()
-        sleep(0.5)
+        if parser.has_option(section, 'enabled') and parser.get(section, 'enabled').strip() == '0':
+            continue
+        keys += [key for key in re.split(r'[\s,]+', parser.get(section, 'gpgkey')) if key and key not in keys]
+    return keys
+
+
+@contextmanager
+def local_repo(name, repo_dir, gpgcheck=False, gpgkeys=()):
+    """ A yum repo definition for repo_dir that exists for the duration of the with block """
+    path = '/etc/yum.repos.d/%s.repo' % name
+    with open(path, 'w') as fh:
+        fh.write('[%s]\nname=%s\nbaseurl=file://%s\nenabled=0\ngpgcheck=%d\n' % (
+            name, name, os.path.abspath(repo_dir), gpgcheck))
+        if gpgkeys:
+            fh.write('gpgkey=%s\n' % ' '.join(gpgkeys))
+    try:
+        yield ['--disablerepo=*', '--enablerepo=%s' % name]
+    finally:
+        os.remove(path)
+
+
+class RpmCache(object):
+    """ A yum repository of every RPM prep has installed, at path, which may be shared between hosts on NFS.
+        The first host fills it from the mirrors with parallel fetches and createrepo, later hosts install from
+        it alone through a temporary .repo with fastestmirror disabled, so nothing waits on mirror probing.
+        An flock on path/.lock keeps hosts from filling it at the same time or reading it mid-update.
+        Filling needs tools, yum-utils and createrepo, that minimal installs lack. Without them a host only
+        installs from what another host has already cached.
+    """
+
+    tools = ('yumdownloader', 'createrepo')
+
+    def __init__(self, path=RPM_CACHE, concurrency=RPM_CONCURRENCY):
+        self.path = path
+        self.concurrency = concurrency
+        self.session = XchangeSession(username=None)
+
+    @contextmanager
+    def locked(self, operation):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, '.lock'), 'a') as fh:
+            fcntl.flock(fh.fileno(), operation)
+            yield
+
+    def rpms(self):
+        return [os.path.join(self.path, f) for f in sorted(os.listdir(self.path)) if f.endswith('.rpm')]
+
+    def contents(self):
+        """ NAME.ARCH of every cached RPM """
+        rpms = self.rpms()
+        if not rpms:
+            return set()
+        output = subprocess.Popen(['rpm', '-qp', '--nosignature', '--qf', '%{NAME}.%{ARCH}\n'] + rpms,
+                                  stdout=subprocess.PIPE).communicate()[0]
+        return set(output.split())
+
+    def urls(self, names):
+        """ Mirror URLs of names and the dependencies they would pull in that aren't installed """
+        output = subprocess.Popen(['yumdownloader', '-q', '--urls', '--resolve', '--disableplugin=fastestmirror']
+                                  + names, stdout=subprocess.PIPE).communicate()[0]
+        return [line for line in output.split() if re.match(r'(https?|file)://\S+\.rpm$', line)]
+
+    def fill(self, names):
+        """ Fetch names and their dependencies that aren't cached yet, concurrency at a time, then update the
+            repodata. A failed fetch is only warned about, yum falls back to the mirrors for it. Progress is logged
+            per RPM rather than drawn, fill() can run alongside the downloads and their progress line.
+            The fetches go into report.packages as a total rather than one report.downloads entry each.
+            Returns the number of RPMs added.
+        """
+        urls = [url for url in (self.urls(names) if names else [])
+                if not os.path.isfile(os.path.join(self.path, os.path.basename(url)))]
+        pending = iter(urls)
+        lock = threading.Lock()
+        added = []
+        fetched = [0]
+
+        def worker():
+            while True:
+                with lock:
+                    url = next(pending, None)
+                if url is None:
+                    return
+                base_url, _, item = url.rpartition('/')
+                save_as = os.path.join(self.path, urllib2.unquote(item))
+                try:
+                    if url.startswith('file://'):
+                        link_or_copy(urllib2.unquote(urlparse.urlsplit(url).path), save_as)
+                        size = os.path.getsize(save_as)
+                    else:
+                        size = download(base_url + '/', item, save_as, report_hook=None, retries=2,
+                                        segments=1, cache_dir=None, opener=self.session.open, record=False)
+                    with lock:
+                        added.append(item)
+                        fetched[0] += size
+                        logger.debug("Cached %s (%d of %d)" % (item, len(added), len(urls)))
+                except (DownloadError, OSError, IOError), e:
+                    logger.warning("\x1b[33mUnable to cache %s: %s\x1b[0m" % (url, e))
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.concurrency, len(urls)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        report.packages['fetched_bytes'] = fetched[0]
+        if added or not os.path.isdir(os.path.join(self.path, 'repodata')):
+            if subprocess.Popen(['createrepo', '-q', '--update', self.path]).wait():
+                raise OSError('createrepo %s failed' % self.path)
+        return len(added)
+
+    def install(self, names):
+        """ yum install names from the cache, filling it with the ones it doesn't hold first. If the cache can't
+            satisfy the transaction yum runs again with the configured repos as well, if it has no repodata yet
+            yum uses the configured repos alone. Cached RPMs are checked
+            against the gpgkeys of the configured repos they were fetched from. The cache hit rate,
+            fetch and install durations go into the run report. Returns yum's exit code.
+        """
+        with self.locked(fcntl.LOCK_EX):
+            cached = self.contents()
+            hits = len([p for p in names if p in cached])
+            logger.info("\x1b[32m%d of %d missing packages found in RPM cache %s\x1b[0m" % (
+                hits, len(names), self.path))
+            report.packages.update({'cache': self.path, 'cache_hits': hits,
+                                    'cache_hit_rate': round(float(hits) / len(names), 3)})
+            started = time()
+            added = 0
+            missing_tools = [tool for tool in self.tools if not find_executable(tool)]
+            if missing_tools:
+                logger.warning("\x1b[33mNot filling RPM cache %s, %s not installed\x1b[0m" % (
+                    self.path, ' and '.join(missing_tools)))
+            else:
+                try:
+                    added = self.fill([p for p in names if p not in cached])
+                    logger.info("\x1b[32mAdded %d RPMs to %s in %0.1fs\x1b[0m" % (
+                        added, self.path, time() - started))
+                except OSError, e:
+                    logger.warning("\x1b[33mUnable to fill RPM cache %s: %s\x1b[0m" % (self.path, e))
+            report.packages.update({'fetched': added, 'fetch_duration': round(time() - started, 3)})
+        with self.locked(fcntl.LOCK_SH):
+            started = time()
+            yum = ['yum', '-y', '--disableplugin=fastestmirror']
+            if not os.path.isdir(os.path.join(self.path, 'repodata')):
+                logger.info("\x1b[32mRPM cache %s is empty, installing from the configured repos\x1b[0m" % self.path)
+                rc = subprocess.Popen(['yum', '-y', 'install'] + names).wait()
+            else:
+                with local_repo(RPM_REPO, self.path, gpgcheck=True,
+                                gpgkeys=repo_gpgkeys(exclude=[RPM_REPO])) as repo_args:
+                    rc = subprocess.Popen(yum + repo_args + ['install'] + names).wait()
+                    if rc:
+                        logger.warning("\x1b[33mRPM cache %s can't satisfy the install, adding the configured "
+                                       "repos\x1b[0m" % self.path)
+                        rc = subprocess.Popen(yum + ['--enablerepo=%s' % RPM_REPO, 'install'] + names).wait()
+            report.packages['install_duration'] = round(time() - started, 3)
+        return rc
+
+
+def prep_packages(wanted=packages, repo_dir=None, rpm_cache=None):
+    """ yum install only the entries of wanted that rpm doesn't already report, returns the missing list.
+        Raises OSError if yum fails so the packages stage isn't journalled as complete.
+        With repo_dir, eg: RPMs extracted from a Bundle, yum installs from that directory alone, checking
+        signatures against the configured repos' gpgkeys, otherwise with an RpmCache yum installs through the cache.
+    """
+    started = time()
+    try:
+        installed = installed_packages()
+    except OSError, e:
+        logger.error("\x1b[31mUnable to query installed packages: %s\x1b[0m" % e)
+        installed = set()
+    missing = [p for p in wanted if p not in installed]
+    logger.info("\x1b[32mQueried %d installed packages in %0.2fs, %d of %d required packages missing\x1b[0m" % (
+        len(installed), time() - started, len(missing), len(wanted)))
+    report.packages.update({'required': len(wanted), 'missing': len(missing)})
+    if not missing:
+        return missing
+    started = time()
+    if repo_dir:
+        with local_repo(BUNDLE_REPO, repo_dir, gpgcheck=True,
+                        gpgkeys=repo_gpgkeys(exclude=[BUNDLE_REPO, RPM_REPO])) as repo_args:
+            rc = subprocess.Popen(['yum', '-y'] + repo_args + ['install'] + missing).wait()
+    elif rpm_cache:
+        rc = rpm_cache.install(missing)
+    else:
+        rc = subprocess.Popen(['yum', '-y', 'install'] + missing).wait()
+    report.packages.update({'exit_code': rc, 'duration': round(time() - started, 3)})
+    if rc:
+        raise OSError('yum install exited with %d after %0.1fs' % (rc, time() - started))
+    logger.info("\x1b[32mInstalled %d packages in %0.1fs\x1b[0m" % (len(missing), time() - started))
+    return missing
+
+
+def confirm(question):
+    while True:
+        ans = raw_input(question).lower()
+        if ans in ('y', 'n'):
+            return ans == 'y'
+
+
+def edit_file(path, pattern, replacement):
+    """ re.sub pattern in path, only writing when the content actually changes. A .orig copy of the untouched
+        file is kept the first time. Returns True if the file was changed.
+    """
+    try:
+        with open(path) as fh:
+            content = fh.read()
+    except IOError, e:
+        logger.error("\x1b[31mUnable to read %s: %s\x1b[0m" % (path, e))
+        return False
+    updated = re.sub(pattern, replacement, content, flags=re.M)
+    if updated == content:
+        return False
+    if not os.path.exists(path + '.orig'):
+        shutil.copy2(path, path + '.orig')
+    with open(path + '.tmp', 'w') as fh:
+        fh.write(updated)
+    shutil.copymode(path, path + '.tmp')
+    os.rename(path + '.tmp', path)
+    return True
+
+
+def set_sysctl(path, settings):
+    """ Make sure every key = value in settings is present in path, replacing other values for those keys """
+    try:
+        with open(path) as fh:
+            lines = fh.read().splitlines()
+    except IOError:
+        lines = []
+    missing = OrderedDict(settings)
+    updated = []
+    for line in lines:
+        key = line.split('=')[0].strip()
+        if '=' in line and not line.lstrip().startswith('#') and key in settings:
+            line = '%s = %s' % (key, missing.pop(key, settings[key]))
+        updated.append(line)
+    updated.extend('%s = %s' % (key, value) for key, value in missing.items())
+    if updated == lines:
+        return False
+    with open(path + '.tmp', 'w') as fh:
+        fh.write('\n'.join(updated) + '\n')
+    if os.path.exists(path):
+        shutil.copymode(path, path + '.tmp')
+    os.rename(path + '.tmp', path)
+    return True
+
+
+def configure_services(services, restart=()):
+    """ Bring services to {name: enabled} with one chkconfig listing, one status query and one batch of commands.
+        Enabled services are added to runlevels 3 4 5 and started, or restarted if in restart, disabled ones are
+        stopped and turned off. Services already in the wanted state are left alone.
+    """
+    listing = subprocess.Popen('/sbin/chkconfig --list', shell=True, stdout=subprocess.PIPE).communicate()[0]
+    levels = {}
+    for line in listing.splitlines():
+        fields = line.split()
+        if fields:
+            levels[fields[0]] = set(f.split(':')[0] for f in fields[1:] if f.endswith(':on'))
+    status = subprocess.Popen(
+        'for s in %s; do /etc/init.d/$s status >/dev/null 2>&1; echo $s $?; done' % ' '.join(services),
+        shell=True, stdout=subprocess.PIPE).communicate()[0]
+    running = set(line.split()[0] for line in status.splitlines() if line.split()[1:] == ['0'])
+    commands = []
+    for name, enabled in services.items():
+        if enabled:
+            if not set('345') <= levels.get(name, set()):
+                logger.info("\x1b[32mAdding %s to 3 4 5 runlevels\x1b[0m" % name)
+                commands.append('/sbin/chkconfig --add %s; /sbin/chkconfig --level 345 %s on; '
+                                '/sbin/chkconfig --level 345 %s resetpriorities' % (name, name, name))
+            if name not in running:
+                commands.append('/etc/init.d/%s start' % name)
+            elif name in restart:
+                commands.append('/etc/init.d/%s restart' % name)
+        else:
+            if name in running:
+                logger.info("\x1b[32mStopping %s\x1b[0m" % name)
+                commands.append('/etc/init.d/%s stop' % name)
+            if levels.get(name):
+                logger.info("\x1b[32mDisabling %s\x1b[0m" % name)
+                commands.append('/sbin/chkconfig %s off' % name)
+    if commands:
+        subprocess.Popen('; '.join(commands), shell=True).wait()
+    return commands
+
+
+def configure_os():
+    """ Apply os_file_edits, os_sysctl and os_services. Every task compares before writing so a rerun on a
+        configured host changes nothing and runs no service commands.
+    """
+    changed = set()
+    for description, path, pattern, replacement in os_file_edits:
+        with report.stage('configure_os:%s' % path):
+            edited = edit_file(path, pattern, replacement)
+        if edited:
+            logger.info("\x1b[32m%s\x1b[0m" % description)
+            changed.add(path)
+        else:
+            logger.info("\x1b[32m%s: already applied\x1b[0m" % description)
+    with report.stage('configure_os:/etc/sysctl.conf'):
+        edited = set_sysctl('/etc/sysctl.conf', os_sysctl)
+    if edited:
         logger.info("\x1b[32mDisabled ipv6\x1b[0m")
-        with open('/etc/sysctl.conf', 'a+') as fh:
-            fh.write('\nnet.ipv6.conf.all.disable_ipv6 = 1\n')
-            fh.write('net.ipv6.conf.default.disable_ipv6 = 1\n')
-            fh.write('net.ipv6.conf.lo.disable_ipv6 = 1\n')
-        logger.info("\x1b[32mBroadworks prerequisites complete.\x1b[0m")
+    else:
+        logger.info("\x1b[32mDisabled ipv6: already applied\x1b[0m")
+    with report.stage('configure_os:services'):
+        configure_services(os_services, restart=[name for name, path in os_service_configs.items() if path in changed])
+    logger.info("\x1b[32mBroadworks prerequisites complete.\x1b[0m")
 
 
 def menu():
@@ -523,49 +2763,267 @@ def menu():
         return result
 
 
+class InstallerPump(object):
+    """ Reads the installer's stdout and stderr on a thread as it arrives, echoing it unchanged and teeing each
+        line with a timestamp to a RotatingFileHandler. A line matching one of phases starts that phase, the
+        time spent in each is kept in durations. Before the first match the time counts as 'startup'.
+    """
+
+    def __init__(self, stream, log_path=INSTALLER_LOG, phases=installer_phases, echo=sys.stdout):
+        self.stream = stream
+        self.echo = echo
+        self.phases = [(name, re.compile(pattern)) for name, pattern in phases]
+        self.durations = OrderedDict()
+        self.phase = None
+        self.closed = False
+        self.lock = threading.Lock()
+        createDirForFile(log_path)
+        self.handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=INSTALLER_LOG_SIZE,
+                                                            backupCount=INSTALLER_LOG_BACKUPS)
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self.log = logging.getLogger('BroadworksBootstrap.installer')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.addHandler(self.handler)
+        self.enter('startup')
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enter(self, name, now=None):
+        """ End the current phase, adding its time to durations, and start name, None just ends it """
+        now = now or time()
+        with self.lock:
+            if self.phase:
+                current, started = self.phase
+                self.durations[current] = round(self.durations.get(current, 0) + now - started, 3)
+            self.phase = (name, now) if name else None
+        if name and name != 'startup':
+            logger.info("\x1b[32mInstaller phase %s started\x1b[0m" % name)
+
+    def line(self, text):
+        self.log.info(text)
+        for name, pattern in self.phases:
+            if pattern.search(text):
+                if self.phase and self.phase[0] != name:
+                    self.enter(name)
+                return
+
+    def run(self):
+        pending = ''
+        while not self.closed:
+            data = os.read(self.stream.fileno(), 4096)
+            if not data:
+                break
+            self.echo.write(data)
+            self.echo.flush()
+            lines = re.split(r'\r\n|\r|\n', pending + data)
+            pending = lines.pop()
+            for text in lines:
+                if text.strip():
+                    self.line(text)
+        if pending.strip() and not self.closed:
+            self.line(pending)
+
+    def close(self, finished=None, timeout=5):
+        """ Wait up to timeout for the rest of the output, daemons the installer started may hold the pipe open
+            long after it exits, then end the current phase at finished and close the log. Returns durations.
+        """
+        self.thread.join(timeout)
+        self.closed = True
+        self.enter(None, finished)
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+        return self.durations
+
+
+def run_installer(result, path, timeout=INSTALLER_TIMEOUT, log_path=INSTALLER_LOG):
+    """ Run the installer in its own process group with its output pumped through an InstallerPump.
+        A watchdog sends the group SIGTERM once timeout seconds have passed, 0 for none, and SIGKILL
+        INSTALLER_KILL_GRACE seconds later. The exit code, phase durations and log go into the run report.
+        A non-zero exit raises OSError so the install stage, and the run, fail.
+    """
+    os.chdir(path)
+    started = time()
+    process = subprocess.Popen(
+        './%s -patch %s%s %s%s' % (result.get('installer'), path, result.get('patch'), path, "unattended.conf"),
+        shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    pump = InstallerPump(process.stdout, log_path)
+    timed_out = False
+    while process.poll() is None:
+        elapsed = time() - started
+        if timeout and elapsed > timeout + (INSTALLER_KILL_GRACE if timed_out else 0):
+            if not timed_out:
+                logger.error("\x1b[31mInstaller still running after %ds in phase %s, stopping it\x1b[0m" % (
+                    timeout, pump.phase[0]))
+            try:
+                os.killpg(process.pid, signal.SIGKILL if timed_out else signal.SIGTERM)
+            except OSError:
+                pass
+            timed_out = True
+        sleep(0.5)
+    rc, finished = process.returncode, time()
+    phases = pump.close(finished)
+    report.installer.update({'exit_code': rc, 'duration': round(finished - started, 3), 'phases': phases,
+                             'timed_out': timed_out, 'log': log_path})
+    logger.info("\x1b[32mInstaller phases: %s\x1b[0m" % ', '.join(
+        '%s %0.1fs' % (name, duration) for name, duration in phases.items()))
+    if rc:
+        raise OSError('Installer exited with %d%s' % (rc, ' after timing out' if timed_out else ''))
+    return rc
+
+
+def bootstrap_stages(result, o, path, prep, configure, abort):
+    """ Stage graph for a bootstrap run: artifact downloads and unattended.conf have no dependencies so they
+        run alongside package prep and OS config, the installer waits for everything it reads.
+        With o.from_bundle the artifacts, RPMs and unattended.conf template all come from the Bundle instead.
+        Returns the stages and the download TransferProgress.
+    """
+    bundle = Bundle(o.from_bundle) if o.from_bundle else None
+    if bundle:
+        stages, progress = bundle_stages(bundle, path), TransferProgress(0)
+    else:
+        stages, progress = download_stages(release_downloads(result), path, o.concurrency, o.segments, o.cache_dir,
+                                           Manifest(o.manifest), '%s/%s' % (result.get('type'), result.get('release')),
+                                           abort, PeerSet(o.peers, o.port) if o.peers else None)
+    stages.append(Stage('executable', lambda results: [
+        setExecute("%s%s" % (path, results['download:%s' % label])) for label in ('installer', 'swmanager')],
+        ['download:installer', 'download:swmanager']))
+    if bundle:
+        stages.append(Stage('unattended_config', lambda results: fill_placeholders(
+            bundle.extract('unattended.conf', "%sunattended.conf" % path), o.fqdn),
+            inputs={'bundle': bundle.path, 'sha256': bundle.members['unattended.conf']['sha256'], 'fqdn': o.fqdn},
+            verify=lambda output: os.path.isfile("%sunattended.conf" % path)))
+    else:
+        stages.append(Stage('unattended_config', lambda results: createUnattenededInstallConfig(
+            "%sunattended.conf" % path, result.get('options'), o.fqdn),
+            inputs={'options': result.get('options'), 'fqdn': o.fqdn},
+            verify=lambda output: os.path.isfile("%sunattended.conf" % path)))
+    if prep:
+        if bundle:
+            stages.append(Stage('packages', lambda results: prep_packages(
+                repo_dir=bundle.extract_repo(path + 'rpms/')), inputs={'packages': packages, 'bundle': bundle.path}))
+        else:
+            stages.append(Stage('packages', lambda results: prep_packages(
+                rpm_cache=RpmCache(o.rpm_cache, o.rpm_concurrency) if o.rpm_cache else None), inputs=packages))
+        if configure:
+            stages.append(Stage('configure_os', lambda results: configure_os(), ['packages'],
+                                inputs=[os_file_edits, os_sysctl, os_services]))
+    elif not o.download_only:
+        stages.append(Stage('install', lambda results: run_installer(result, path, o.installer_timeout,
+                                                                     o.installer_log),
+                            [stage.name for stage in stages], inputs=[result.get('installer'), result.get('patch')],
+                            verify=lambda rc: rc == 0))
+    return stages, progress
+
+
+def wait_forever():
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+def publish_report(o):
+    try:
+        report.write(o.report)
+        if o.prom_textfile:
+            report.write_prometheus(o.prom_textfile)
+        if o.statsd:
+            report.send_statsd(o.statsd)
+        logger.info("\x1b[32mWrote run report %s\x1b[0m" % o.report)
+    except (IOError, OSError, socket.error), e:
+        logger.error("\x1b[31mUnable to publish run report: %s\x1b[0m" % e)
+
+
 def main():
     if not os.geteuid() == 0:
         logger.critical("\x1b[31mMust be executed as root user\x1b[0m")
         sys.exit(1)
     result, o = opts()
+    if o.resume:
+        journal = StateJournal(o.state)
+        if not journal.data.get('resume'):
+            logger.info("\x1b[32mNothing to resume\x1b[0m")
+            disarm_resume(journal)
+            return
+        result, o = opts(journal.data['resume'] + ['--state=%s' % o.state, '--resume'])
+    bandwidth.configure(o.bandwidth, o.bandwidth_file)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: bandwidth.reload())
+    server = start_peer_server(o.port, (INSTALL_DIR,), o.cache_dir, o.manifest) if o.serve else None
+    if server and not result:
+        logger.info("\x1b[32mServing only, ctl+c to stop\x1b[0m")
+        wait_forever()
+        return
+    if o.bundle:
+        if not result:
+            logger.critical("\x1b[31m--bundle needs --type and --release\x1b[0m")
+            sys.exit(1)
+        try:
+            build_bundle(result, o)
+        finally:
+            publish_report(o)
+        return
     if not result:
         result = menu()
         if result.get('type') and result.get('release'):
             o.autoinstall = True
-    if o.autoinstall or o.sysprep or not o.skipprep:
-        subprocess.Popen('yum -y install %s' % ' '.join(packages), shell=True).wait()
-        sleep(1)
-        configure_os()
-        while True:
-            ans = raw_input("\x1b[34mReboot and trigger automated Broadworks installation? y/n: \x1b[0m")
-            if ans == 'y' or ans == 'Y':
-                subprocess.Popen('echo "python /root/bwbootstrap.py --autoinstall --type=%s --release=%s" >> /root/.bashrc'
-                                 % (result.get('type'), result.get('release')), shell=True).wait()
-                sleep(0.5)
-                logger.info("\x1b[32mAutolaunch armed, rebooting.....\x1b[0m")
-                os.system('reboot')
-            if ans == 'n' or ans == 'N':
-                break
-        sys.exit()
-    if o.autoinstall or o.install:
-        path = '/bw/install/'
+    report.info.update({'type': result.get('type'), 'release': result.get('release'), 'host': socket.gethostname()})
+    try:
+        bootstrap(result, o)
+    finally:
+        publish_report(o)
+    if o.resume:
+        disarm_resume(StateJournal(o.state))
+    if server:
+        logger.info("\x1b[32mStill serving to peers, ctl+c to stop\x1b[0m")
+        wait_forever()
+
+
+def resume_args(result, o):
+    """ Command line for the install run after the reboot, carrying over this run's download and report settings """
+    args = ['--install', '--skipprep', '--type=%s' % result.get('type'), '--release=%s' % result.get('release'),
+            '--concurrency=%d' % o.concurrency, '--segments=%d' % o.segments, '--cache-dir=%s' % o.cache_dir,
+            '--manifest=%s' % o.manifest, '--report=%s' % o.report,
+            '--installer-timeout=%d' % o.installer_timeout, '--installer-log=%s' % o.installer_log,
+            '--bandwidth=%s' % o.bandwidth, '--bandwidth-file=%s' % o.bandwidth_file]
+    for name in ('fqdn', 'statsd', 'prom_textfile'):
+        if getattr(o, name):
+            args.append('--%s=%s' % (name.replace('_', '-'), getattr(o, name)))
+    if o.from_bundle:
+        args.append('--from-bundle=%s' % os.path.abspath(o.from_bundle))
+    return args + ['--peer=%s' % peer for peer in o.peers]
+
+
+def bootstrap(result, o):
+    prep = o.autoinstall or o.sysprep or not o.skipprep
+    journal = StateJournal(o.state, '%s/%s' % (result.get('type'), result.get('release')))
+    if prep or o.install or o.download_only:
+        path = INSTALL_DIR
+        configure = prep and (o.yes or confirm("Do you wish to pre-configure the OS and reboot? [y/n]: "))
         logger.info("\x1b[32mBootstrapping install for Broadworks %s %s \x1b[0m" % (
             result.get('options').get('SERVER_TYPE'), result.get('release')))
-        download(bss_url.replace('__RELEASE__', result.get('release')), result.get('installer'),
-                 "%s%s" % (path, result.get('installer')))
-        download(ips_url.replace('__RELEASE__', result.get('release')), result.get('patch'),
-                 "%s%s" % (path, result.get('patch')))
-        swmanager = get_latest_swman()
-        download(swm_url, swmanager, "%s%s" % (path, swmanager))
-        setExecute("%s%s" % (path, swmanager))
-        setExecute("%s%s" % (path, result.get('installer')))
-        createUnattenededInstallConfig("%sunattended.conf" % path, result.get('options'))
-        if not o.download_only:
-            os.chdir(path)
-            subprocess.Popen(
-                './%s -patch %s%s %s%s' % (result.get('installer'), path, result.get('patch'), path, "unattended.conf"),
-                shell=True).wait()
-            subprocess.Popen("sed -i '/python \/root\/bwbootstrap.py --install/d' /root/.bashrc", shell=True).wait()
+        abort = threading.Event()
+        try:
+            stages, progress = bootstrap_stages(result, o, path, prep, configure, abort)
+            try:
+                run_stages(stages, abort, journal)
+            finally:
+                progress.finish()
+        except (StageError, ManifestError), e:
+            logger.critical("\x1b[31m%s\x1b[0m" % e)
+            sys.exit(1)
+    if prep:
+        if o.yes or confirm("\x1b[34mReboot and trigger automated Broadworks installation? y/n: \x1b[0m"):
+            arm_resume(journal, resume_args(result, o))
+            logger.info("\x1b[32mAutolaunch armed, rebooting.....\x1b[0m")
+            publish_report(o)
+            os.system('reboot')
+            sys.exit()
+        if not o.serve:
+            sys.exit()
+        return
     logger.info("\x1b[32mFinished\x1b[0m")
 
 
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+import json
+import os
+import pipes
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from optparse import OptionParser
+from time import sleep, time
+
+import bwbootstrap
+
+__author__ = 'luke beer - eat.lemons@gmail.com - https://github.com/lukebeer'
+
+""" Bootstrap a cluster from one box. Reads an inventory of hosts and the type/release each one gets, stages the
+    artifacts once locally and serves them to the hosts as a bwbootstrap peer, then pushes bwbootstrap.py to
+    every host and runs it unattended, a bounded number of hosts at a time. Output is streamed back prefixed
+    with the host name and a per-host stage timing summary is printed at the end.
+
+    Inventory, one host per line, optional key=value settings after the release:
+
+        # host              type  release      settings
+        as1.example.com     as    21.sp1.551   group=as-pair
+        as2.example.com     as    21.sp1.551   group=as-pair
+        ns1.example.com     ns    21.sp1.551   mode=auto user=admin port=2222
+
+    bash-$ python bwfleet.py cluster.txt --parallel 4 --limit as-pair=1
+
+    Hosts are reached through a command template, ssh by default. `--connect local` runs everything on this box
+    with sh, and a template such as 'docker exec -i {host} sh -c' drives containers.
+"""
+
+CONNECT_TEMPLATES = {'ssh': 'ssh -o BatchMode=yes -o ConnectTimeout=10 -p {port} {user}@{host}',
+                     'local': 'sh -c'}
+REMOTE_DIR = '/root'
+REBOOT_TIMEOUT = 3600
+POLL_INTERVAL = 15
+
+output_lock = threading.Lock()
+
+
+def log(host, line):
+    with output_lock:
+        sys.stdout.write('%-24s | %s\n' % (host, line))
+        sys.stdout.flush()
+
+
+def read_inventory(path):
+    """ [{'host', 'type', 'release', settings...}] from an inventory file """
+    hosts = []
+    with open(path) as fh:
+        for n, line in enumerate(fh):
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if len(fields) < 3:
+                raise ValueError('%s:%d: expected host type release [key=value ...]' % (path, n + 1))
+            host = {'host': fields[0], 'type': fields[1].lower(), 'release': fields[2]}
+            for setting in fields[3:]:
+                key, _, value = setting.partition('=')
+                host[key] = value
+            if host['release'] not in bwbootstrap.configs.get(host['type'], {}).get('software', {}):
+                raise ValueError('%s:%d: unknown type/release %s/%s' % (path, n + 1, host['type'], host['release']))
+            hosts.append(host)
+    return hosts
+
+
+class Transport(object):
+    """ Runs shell commands on one host through a command template, the command is passed as its last argument """
+
+    def __init__(self, template, host, user='root', port=22):
+        self.prefix = [arg.format(host=host, user=user, port=port) for arg in shlex.split(template)]
+        self.host = host
+
+    def run(self, command, stream=True, stdin=None):
+        """ (exit code, output), each line is logged with the host prefix as it arrives when stream is set """
+        process = subprocess.Popen(self.prefix + [command], stdin=stdin or open(os.devnull),
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = []
+        for line in iter(process.stdout.readline, ''):
+            output.append(line)
+            if stream:
+                # progress lines redraw with \r, only the latest state is worth a line in the log
+                log(self.host, line.rstrip('\r\n').split('\r')[-1])
+        return process.wait(), ''.join(output)
+
+    def push(self, path, remote_path):
+        with open(path, 'rb') as fh:
+            rc, output = self.run('mkdir -p %s && cat > %s' % (os.path.dirname(remote_path), remote_path),
+                                  stream=False, stdin=fh)
+        if rc:
+            raise IOError('Unable to copy %s to %s:%s: %s' % (path, self.host, remote_path, output.strip()))
+
+
+def stage_artifacts(hosts, stage_dir, o):
+    """ Download every artifact the inventory needs into stage_dir once, and serve it to the hosts """
+    manifest = bwbootstrap.Manifest(o.manifest)
+    bwbootstrap.bandwidth.configure(o.bandwidth, bwbootstrap.BANDWIDTH_FILE)
+    for section in sorted(set('%s/%s' % (h['type'], h['release']) for h in hosts)):
+        type, release = section.split('/')
+        result = dict(bwbootstrap.configs[type]['software'][release], type=type, release=release)
+        log('stage', 'Fetching %s artifacts into %s' % (section, stage_dir))
+        bwbootstrap.download_all(bwbootstrap.release_downloads(result), stage_dir, o.concurrency,
+                                 cache_dir=o.cache_dir, manifest=manifest, section=section)
+    return bwbootstrap.start_peer_server(o.port, (stage_dir,), '', o.manifest)
+
+
+def host_dir(host, o):
+    """ Remote directory for the script and report, {host} expands to the host name """
+    return host.get('dir', o.remote_dir).format(host=host['host'])
+
+
+def bootstrap_command(host, o):
+    remote_dir = host_dir(host, o)
+    mode = host.get('mode', o.mode)
+    args = ['-t', host['type'], '-r', host['release'], '--report', '%s/bwbootstrap-report.json' % remote_dir]
+    args += ['--auto', '--yes'] if mode == 'auto' else ['--install', '--skipprep']
+    if o.advertise:
+        args += ['--peer', '%s:%d' % (o.advertise, o.port)]
+    args += shlex.split(host.get('args', '')) + o.remote_args
+    return 'cd %s && %s -u %s/bwbootstrap.py %s' % (remote_dir, host.get('python', o.python), remote_dir,
+                                                    ' '.join(pipes.quote(a) for a in args))
+
+
+def remote_report(transport, path):
+    rc, output = transport.run('cat %s' % path, stream=False)
+    try:
+        return json.loads(output) if not rc else None
+    except ValueError:
+        return None
+
+
+def wait_for_resume(transport, host, report_path, since, timeout=REBOOT_TIMEOUT):
+    """ Wait for the host to reboot and for the resume unit's run to write its report, None on timeout """
+    deadline = time() + timeout
+    log(host, 'Waiting for reboot and resumed install')
+    while time() < deadline:
+        sleep(POLL_INTERVAL)
+        rc, output = transport.run('echo $(date +%%s) $(cut -d. -f1 /proc/uptime) $(stat -c %%Y %s 2>/dev/null || '
+                                   'echo 0)' % report_path, stream=False)
+        fields = output.split()
+        if rc or len(fields) != 3:
+            continue
+        now, uptime, written = [int(f) for f in fields]
+        if now - uptime > since and written > now - uptime:
+            return remote_report(transport, report_path)
+    return None
+
+
+def bootstrap_host(host, o):
+    """ Push and run bwbootstrap on one host, returns its summary """
+    transport = Transport(CONNECT_TEMPLATES.get(o.connect, o.connect), host['host'], host.get('user', 'root'),
+                          host.get('port', 22))
+    remote_dir = host_dir(host, o)
+    report_path = '%s/bwbootstrap-report.json' % remote_dir
+    summary = {'host': host['host'], 'release': '%s/%s' % (host['type'], host['release']), 'reports': []}
+    started = time()
+    try:
+        transport.push(o.script, '%s/bwbootstrap.py' % remote_dir)
+        rc, output = transport.run('date +%s', stream=False)
+        since = int(output.strip() or 0)
+        # a report left by an earlier run mustn't stand in for this one if it dies before writing its own
+        transport.run('rm -f %s' % report_path, stream=False)
+        rc, output = transport.run(bootstrap_command(host, o))
+        if host.get('mode', o.mode) == 'auto' and rc in (0, 255):
+            # the prep run ends in a reboot, usually taking the connection and its report with it
+            resumed = wait_for_resume(transport, host['host'], report_path, since, o.reboot_timeout)
+            if resumed is None:
+                raise IOError('No resumed run within %ds of reboot' % o.reboot_timeout)
+            summary['reports'].append(resumed)
+            rc = resumed.get('installer', {}).get('exit_code', 1)
+        else:
+            report = remote_report(transport, report_path)
+            if report:
+                summary['reports'].append(report)
+                # --download runs have no installer section, their exit code stands
+                rc = rc or report.get('installer', {}).get('exit_code', 0)
+        summary['status'] = 'ok' if rc == 0 else 'failed (%d)' % rc
+    except (IOError, OSError, ValueError), e:
+        log(host['host'], 'Failed: %s' % e)
+        summary['status'] = 'failed (%s)' % e
+    summary['duration'] = round(time() - started, 1)
+    log(host['host'], 'Finished in %0.1fs: %s' % (summary['duration'], summary['status']))
+    return summary
+
+
+def run_fleet(hosts, o):
+    """ Bootstrap hosts with at most o.parallel running at once, and at most limits[group] per group """
+    limits = dict((group, threading.BoundedSemaphore(int(n))) for group, n in (l.split('=') for l in o.limits))
+    slots = threading.BoundedSemaphore(max(1, o.parallel))
+    summaries = [None] * len(hosts)
+
+    def worker(n, host):
+        group = limits.get(host.get('group'))
+        if group:
+            group.acquire()
+        try:
+            with slots:
+                summaries[n] = bootstrap_host(host, o)
+        finally:
+            if group:
+                group.release()
+
+    threads = [threading.Thread(target=worker, args=(n, host)) for n, host in enumerate(hosts)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(0.5)
+    return summaries
+
+
+def print_summary(summaries):
+    print
+    print "%-24s %-16s %-12s %9s  %s" % ('host', 'release', 'status', 'total s', 'stages (s)')
+    for summary in summaries:
+        stages = {}
+        for report in summary['reports']:
+            for name, stage in report.get('stages', {}).items():
+                if ':' not in name or name.startswith('download:'):
+                    stages[name] = stages.get(name, 0) + stage['duration']
+        print "%-24s %-16s %-12s %9.1f  %s" % (
+            summary['host'], summary['release'], summary['status'], summary['duration'],
+            ', '.join('%s %0.1f' % (name, stages[name]) for name in sorted(stages, key=stages.get, reverse=True)))
+
+
+def opts():
+    op = OptionParser(usage='%s [options] inventory' % sys.argv[0])
+    op.add_option('--parallel', dest='parallel', type='int', default=8, help='Hosts bootstrapped at once (default: 8)')
+    op.add_option('--limit', dest='limits', action='append', default=[],
+                  help='group=N, at most N hosts of an inventory group at once, eg: as-pair=1')
+    op.add_option('--connect', dest='connect', default='ssh',
+                  help='ssh, local, or a command template with {host} {user} {port} (default: ssh)')
+    op.add_option('--mode', dest='mode', default='install', choices=['install', 'auto'],
+                  help='install on prepared hosts, or auto to prep, reboot and resume (default: install)')
+    op.add_option('--script', dest='script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  'bwbootstrap.py'), help='bwbootstrap.py to push')
+    op.add_option('--remote-dir', dest='remote_dir', default=REMOTE_DIR,
+                  help='Where the script and its report go on each host (default: %s)' % REMOTE_DIR)
+    op.add_option('--python', dest='python', default='python', help='Remote python (default: python)')
+    op.add_option('--stage-dir', dest='stage_dir', help='Stage artifacts here and serve them to the hosts')
+    op.add_option('--no-stage', dest='stage', action='store_false', default=True,
+                  help='Let every host download from Xchange itself')
+    op.add_option('--advertise', dest='advertise',
+                  help="Address the hosts reach this box on (default: this box's FQDN)")
+    op.add_option('--port', dest='port', type='int', default=bwbootstrap.PEER_PORT,
+                  help='Port to serve staged artifacts on (default: %d)' % bwbootstrap.PEER_PORT)
+    op.add_option('--concurrency', dest='concurrency', type='int', default=bwbootstrap.DOWNLOAD_CONCURRENCY,
+                  help='Parallel staging downloads (default: %d)' % bwbootstrap.DOWNLOAD_CONCURRENCY)
+    op.add_option('--cache-dir', dest='cache_dir', default='', help='Artifact cache for staging')
+    op.add_option('--bandwidth', dest='bandwidth', default=bwbootstrap.BANDWIDTH, metavar='SCHEDULE',
+                  help='Cap for the staging downloads, a rate like 2M or windows like 08:00-18:00=2M,0')
+    op.add_option('--manifest', dest='manifest', default=bwbootstrap.MANIFEST_FILE,
+                  help='Known-good artifact checksums (default: %s)' % bwbootstrap.MANIFEST_FILE)
+    op.add_option('--reboot-timeout', dest='reboot_timeout', type='int', default=REBOOT_TIMEOUT,
+                  help='Seconds to wait for an auto mode host to come back and finish (default: %d)' % REBOOT_TIMEOUT)
+    op.add_option('--json', dest='json', help='Also write the summary and host reports to this JSON file')
+    o, args = op.parse_args()
+    if len(args) < 1:
+        op.error('inventory file required')
+    try:
+        bwbootstrap.parse_schedule(o.bandwidth)
+    except ValueError, e:
+        op.error('--bandwidth: %s' % e)
+    o.remote_args = args[1:]
+    return o, args[0]
+
+
+def main():
+    o, inventory = opts()
+    hosts = read_inventory(inventory)
+    if o.stage:
+        stage_artifacts(hosts, (o.stage_dir or tempfile.mkdtemp(prefix='bwfleet')).rstrip('/') + '/', o)
+        o.advertise = o.advertise or socket.getfqdn()
+    else:
+        o.advertise = None
+    summaries = run_fleet(hosts, o)
+    print_summary(summaries)
+    if o.json:
+        with open(o.json, 'w') as fh:
+            json.dump(summaries, fh, indent=2)
+    if [s for s in summaries if s['status'] != 'ok']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()